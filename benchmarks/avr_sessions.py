@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Drives the YCast Flask app with scripted AVR browsing sessions against the local Radiobrowser stub and reports
+throughput and p50/p99 latency per route.
+
+    python -m benchmarks.avr_sessions [sessions] [threads]
+"""
+import html
+import logging
+import re
+import sys
+import tempfile
+import threading
+import time
+
+from ycast import generic, my_filter, radiobrowser, server
+from ycast.loadgen import percentile
+from benchmarks import stub_server
+
+AVR_PARAMETERS = '&mac=0123456789ab&dlang=eng&fver=1.2'
+PAGE_SIZE = 8
+# letter and range sub-directories of long lists
+BUCKET_URL = re.compile(r'[?&]letter=')
+
+
+class Session:
+    def __init__(self, client, timings, errors):
+        self.client = client
+        self.timings = timings
+        self.errors = errors
+        self.adapter = server.app.url_map.bind('localhost')
+
+    def get(self, url):
+        path = url.split('://', 1)[-1]
+        path = path[path.find('/'):]
+        start = time.perf_counter()
+        response = self.client.get(path)
+        elapsed = time.perf_counter() - start
+        route = self.adapter.match(path.split('?', 1)[0])[0]
+        self.timings.setdefault(route, []).append(elapsed)
+        if response.status_code >= 400:
+            self.errors[route] = self.errors.get(route, 0) + 1
+        return response.get_data().decode('utf-8', 'replace')
+
+    def get_page(self, url, start_item=1):
+        return self.get(url + AVR_PARAMETERS + '&startitems=%d&enditems=%d' % (start_item,
+                                                                               start_item + PAGE_SIZE - 1))
+
+    def open_buckets(self, url, xml, index):
+        """Descends into the letter and range sub-directories of a long list, returns its entries page."""
+        directories = get_directories(xml)
+        while directories and all(BUCKET_URL.search(directory) for directory in directories):
+            url = directories[index % len(directories)]
+            xml = self.get_page(url)
+            directories = get_directories(xml)
+        return url, xml
+
+    def walk_directory(self, directory_url, index, pages):
+        directory_url, xml = self.open_buckets(directory_url, self.get_page(directory_url), index)
+        directories = get_directories(xml)
+        if not directories:
+            return
+        station_list_url, xml = self.open_buckets(directories[index % len(directories)],
+                                                  self.get_page(directories[index % len(directories)]), index)
+        for page in range(pages):
+            if page:
+                xml = self.get_page(station_list_url, page * PAGE_SIZE + 1)
+            # an AVR fetches every logo of a page right after the page itself
+            for icon in re.findall(r'<Logo>([^<]*)</Logo>', xml):
+                self.get(icon)
+        station_ids = re.findall(r'<StationId>([^<]*)</StationId>', xml)
+        if station_ids:
+            self.get('/setupapp/yamaha/asp/browsexml/statxml.asp?vtuner=true&id=' + station_ids[0] + AVR_PARAMETERS)
+            self.get('/ycast/play?id=' + station_ids[0])
+
+    def run(self, index):
+        self.get('/setupapp/yamaha/asp/browsexml/loginXML.asp?token=0')
+        self.get('/setupapp/yamaha/asp/browsexml/loginXML.asp?vtuner=true' + AVR_PARAMETERS)
+        self.get('/setupapp/yamaha/asp/browsexml/navXML.asp?vtuner=true' + AVR_PARAMETERS)
+        category = ('country', 'language', 'genre')[index % 3]
+        self.walk_directory('/ycast/radiobrowser/%s/?vtuner=true' % category, index, pages=2)
+        self.get_page('/ycast/radiobrowser/popular/?vtuner=true')
+        self.get('/setupapp/yamaha/asp/browsexml/search.asp?vtuner=true&search=station' + AVR_PARAMETERS)
+
+
+def get_directories(xml):
+    return [html.unescape(url) for url in re.findall(r'<UrlDir>([^<]*)</UrlDir>', xml)]
+
+
+def run_sessions(session_count, thread_count):
+    timings = {}
+    errors = {}
+    counter = iter(range(session_count))
+    lock = threading.Lock()
+
+    def worker():
+        session = Session(server.app.test_client(), {}, {})
+        while True:
+            with lock:
+                index = next(counter, None)
+            if index is None:
+                break
+            session.run(index)
+        with lock:
+            for route, values in session.timings.items():
+                timings.setdefault(route, []).extend(values)
+            for route, count in session.errors.items():
+                errors[route] = errors.get(route, 0) + count
+
+    threads = [threading.Thread(target=worker) for _ in range(thread_count)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return timings, errors, time.perf_counter() - start
+
+
+def main():
+    session_count = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    thread_count = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    logging.getLogger().setLevel(logging.ERROR)
+    stub = stub_server.start()
+    radiobrowser.API_ENDPOINT = stub_server.get_endpoint(stub)
+    # fresh state and icon cache for every run
+    generic.VAR_PATH = tempfile.mkdtemp(prefix='ycast-benchmark-')
+    generic.CACHE_PATH = generic.VAR_PATH + '/cache'
+    my_filter.init_filter_file()
+    timings, errors, elapsed = run_sessions(session_count, thread_count)
+    # the walks have to reach the stations, otherwise the numbers are not comparable between runs
+    assert timings.get('get_station_icon') and timings.get('get_stream_url'), "no station reached"
+    total = sum(len(values) for values in timings.values())
+    print("%d sessions, %d threads, %d requests in %.2f s (%.1f req/s)" %
+          (session_count, thread_count, total, elapsed, total / elapsed))
+    print("%-32s %7s %7s %9s %9s %9s" % ('route', 'count', 'errors', 'req/s', 'p50 ms', 'p99 ms'))
+    for route, values in sorted(timings.items()):
+        print("%-32s %7d %7d %9.1f %9.1f %9.1f" % (route, len(values), errors.get(route, 0), len(values) / elapsed,
+                                                    percentile(values, 0.5) * 1000,
+                                                    percentile(values, 0.99) * 1000))
+    stub.shutdown()
+
+
+if __name__ == '__main__':
+    main()
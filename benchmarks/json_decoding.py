@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Parse time and peak memory of a ~10 MB Radiobrowser station list, decoded as a whole versus streamed.
+
+    python -m benchmarks.json_decoding [size_mb]
+"""
+import importlib.util
+import json
+import sys
+import time
+import tracemalloc
+
+from ycast import my_filter, radiobrowser
+from benchmarks.station_memory import make_station_json
+
+
+def make_station_list_body(size_mb):
+    stations = []
+    size = 0
+    i = 0
+    while size < size_mb * 1024 * 1024:
+        station_json = make_station_json(i)
+        # the remaining attributes of a Radiobrowser station struct
+        station_json.update({'changeuuid': station_json['stationuuid'], 'serveruuid': None,
+                             'homepage': 'http://www.example.com/%d' % i, 'country': 'Germany', 'state': '',
+                             'iso_3166_2': None, 'lastchangetime': '2022-01-01 00:00:00',
+                             'lastchangetime_iso8601': '2022-01-01T00:00:00Z', 'hls': 0,
+                             'lastcheckok': i % 10 != 0, 'lastchecktime': '2022-01-01 00:00:00',
+                             'lastcheckoktime': '2022-01-01 00:00:00', 'clicktimestamp': '',
+                             'clickcount': i % 500, 'clicktrend': 0, 'ssl_error': 0, 'geo_lat': None,
+                             'geo_long': None, 'has_extended_info': False})
+        station_json['lastcheckok'] = int(station_json['lastcheckok'])
+        encoded = json.dumps(station_json)
+        size += len(encoded) + 1
+        stations.append(encoded)
+        i += 1
+    return ('[' + ','.join(stations) + ']').encode()
+
+
+def convert(stations_json):
+    my_filter.begin_filter()
+    stations = [radiobrowser.Station(station_json) for station_json in stations_json
+                if my_filter.check_station(station_json)]
+    return stations
+
+
+def whole_body(body):
+    return convert(json.loads(body))
+
+
+def whole_body_orjson(body):
+    import orjson
+    return convert(orjson.loads(body))
+
+
+def streamed(body):
+    chunk_size = radiobrowser.STREAM_CHUNK_SIZE
+    chunks = (body[i:i + chunk_size] for i in range(0, len(body), chunk_size))
+    return convert(radiobrowser.iter_json_array(chunks))
+
+
+def measure(name, function, body):
+    start = time.perf_counter()
+    stations = function(body)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    function(body)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print("%-14s %6d stations  %7.1f ms  peak %6.1f MiB" % (name, len(stations), elapsed * 1000, peak / 1048576))
+
+
+def main():
+    size_mb = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    body = make_station_list_body(size_mb)
+    print("response: %.1f MiB" % (len(body) / 1048576))
+    my_filter.white_list = {'lastcheckok': 1, 'codec': 'MP3'}
+    my_filter.black_list = {}
+    measure('whole body', whole_body, body)
+    if importlib.util.find_spec('orjson'):
+        measure('whole (orjson)', whole_body_orjson, body)
+    measure('streamed', streamed, body)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+Records Radiobrowser API responses into benchmarks/fixtures/ for the stub server.
+
+    python -m benchmarks.record_fixtures [station_limit]
+"""
+import os
+import sys
+
+import requests
+
+from ycast import radiobrowser
+from benchmarks.stub_server import FIXTURES_PATH
+
+RECORDINGS = {
+    'countries': 'countries?hidebroken=true',
+    'languages': 'languages?hidebroken=true',
+    'tags': 'tags?hidebroken=true',
+}
+
+
+def record(name, apicall):
+    response = requests.get(radiobrowser.API_ENDPOINT + '/json/' + apicall, timeout=60)
+    response.raise_for_status()
+    with open(os.path.join(FIXTURES_PATH, name + '.json'), 'wb') as f:
+        f.write(response.content)
+    print("%-10s %8d bytes" % (name, len(response.content)))
+
+
+def main():
+    station_limit = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    os.makedirs(FIXTURES_PATH, exist_ok=True)
+    for name, apicall in RECORDINGS.items():
+        record(name, apicall)
+    record('stations', 'stations?hidebroken=true&order=votes&reverse=true&limit=' + str(station_limit))
+
+
+if __name__ == '__main__':
+    main()
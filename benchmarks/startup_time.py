@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+Cold start time of the ycast package and the slowest imports.
+
+    python -m benchmarks.startup_time [runs]
+"""
+import subprocess
+import sys
+import time
+
+COMMANDS = {
+    'python -m ycast -h': [sys.executable, '-m', 'ycast', '-h'],
+    'import ycast.server': [sys.executable, '-c', 'import ycast.server'],
+}
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    for name, command in COMMANDS.items():
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            timings.append(time.perf_counter() - start)
+        print("%-22s best %6.1f ms  median %6.1f ms" % (name, min(timings) * 1000,
+                                                        sorted(timings)[len(timings) // 2] * 1000))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ycast.server'],
+                            capture_output=True, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines()[1:]:
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        imports.append((int(self_us), name.strip()))
+    print("slowest imports (self time):")
+    for self_us, name in sorted(imports, reverse=True)[:10]:
+        print("  %8.1f ms  %s" % (self_us / 1000, name))
+
+
+if __name__ == '__main__':
+    main()
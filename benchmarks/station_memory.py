@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Memory per station on a synthetic 30k station Radiobrowser listing.
+
+    python -m benchmarks.station_memory [count]
+"""
+import sys
+import tracemalloc
+import uuid
+
+from ycast import radiobrowser
+
+CODECS = ['MP3', 'AAC', 'AAC+', 'OGG', 'FLAC']
+COUNTRIES = [('DE', 'german', 'de'), ('US', 'english', 'en'), ('NL', 'dutch', 'nl'), ('FR', 'french', 'fr')]
+
+
+def make_station_json(i):
+    countrycode, language, languagecodes = COUNTRIES[i % len(COUNTRIES)]
+    # build the repetitive values at runtime like a JSON decoder would, so interning can pay off
+    return {
+        'stationuuid': str(uuid.UUID(int=i + 1)),
+        'name': 'Station %d' % i,
+        'url': 'http://stream.example.com/%d.mp3' % i,
+        'url_resolved': 'http://stream.example.com/%d.mp3' % i,
+        'favicon': 'http://stream.example.com/%d.png' % i,
+        'tags': 'pop,rock,station %d' % (i % 100),
+        'countrycode': ''.join(countrycode),
+        'language': ''.join(language),
+        'languagecodes': ''.join(languagecodes),
+        'votes': i % 1000,
+        'codec': ''.join(CODECS[i % len(CODECS)]),
+        'bitrate': 128,
+    }
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 30000
+    stations_json = [make_station_json(i) for i in range(count)]
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    stations = [radiobrowser.Station(station_json) for station_json in stations_json]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    # the source dicts are released once a listing has been converted
+    del stations_json
+    total = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    print("stations: %d" % len(stations))
+    print("total:    %.1f KiB" % (total / 1024))
+    print("station:  %.1f bytes" % (total / len(stations)))
+
+
+if __name__ == '__main__':
+    main()
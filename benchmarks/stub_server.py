@@ -0,0 +1,159 @@
+"""
+Local stand-in for the Radiobrowser API that replays recorded responses.
+
+Responses are read from benchmarks/fixtures/ (see record_fixtures.py). Fixtures that have not been recorded are
+replaced by deterministic synthetic data, so the benchmarks also run on a fresh checkout without network access.
+Station favicons are rewritten to sample images served by the stub itself.
+"""
+import io
+import json
+import os
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+FIXTURES_PATH = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+COUNTRIES = ['Germany', 'Netherlands', 'France', 'Austria', 'Switzerland', 'Italy', 'Spain', 'Norway']
+LANGUAGES = [('german', 'de'), ('dutch', 'nl'), ('french', 'fr'), ('italian', 'it'), ('spanish', 'es'),
+             ('norwegian', 'no'), ('english', 'en')]
+GENRES = ['pop', 'rock', 'jazz', 'classical', 'news', 'talk', 'dance', 'electronic', 'oldies', 'hits',
+          'metal', 'folk', 'country', 'blues', 'ambient', 'chillout', 'schlager', 'soul', 'techno', 'house']
+CODECS = ['MP3', 'AAC', 'AAC+', 'OGG']
+
+
+def read_fixture(name):
+    try:
+        with open(os.path.join(FIXTURES_PATH, name + '.json'), 'rb') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def make_stations(count=2000):
+    stations = []
+    for i in range(count):
+        language, languagecode = LANGUAGES[i % len(LANGUAGES)]
+        stations.append({
+            'stationuuid': str(uuid.UUID(int=i + 1)),
+            'name': 'Station %04d %s' % (i, GENRES[i % len(GENRES)].title()),
+            'url': 'http://stream.example.com/%d.mp3' % i,
+            'url_resolved': 'http://stream.example.com/%d.mp3' % i,
+            'homepage': 'http://www.example.com/%d' % i,
+            'favicon': 'http://www.example.com/%d.png' % i,
+            'tags': ','.join((GENRES[i % len(GENRES)], GENRES[(i * 7) % len(GENRES)])),
+            'country': COUNTRIES[i % len(COUNTRIES)],
+            'countrycode': COUNTRIES[i % len(COUNTRIES)][:2].upper(),
+            'language': language,
+            'languagecodes': languagecode,
+            'votes': (i * 7919) % 5000,
+            'codec': CODECS[i % len(CODECS)],
+            'bitrate': (64, 128, 192, 320)[i % 4],
+            'lastcheckok': int(i % 17 != 0),
+            'hls': 0,
+        })
+    return stations
+
+
+def make_directory(stations, attribute):
+    counts = {}
+    for station in stations:
+        for name in station[attribute].split(','):
+            counts[name] = counts.get(name, 0) + 1
+    return [{'name': name, 'stationcount': count} for name, count in sorted(counts.items())]
+
+
+def make_favicon(size=(96, 64)):
+    from PIL import Image
+    output = io.BytesIO()
+    Image.new('RGB', size, (200, 60, 30)).save(output, format='PNG')
+    return output.getvalue()
+
+
+class Fixtures:
+    def __init__(self):
+        self.stations = read_fixture('stations') or make_stations()
+        self.countries = read_fixture('countries') or make_directory(self.stations, 'country')
+        self.languages = read_fixture('languages') or \
+            [dict(language, iso_639=language['name'][:2]) for language in make_directory(self.stations, 'language')]
+        self.tags = read_fixture('tags') or make_directory(self.stations, 'tags')
+        self.by_uuid = {station['stationuuid']: station for station in self.stations}
+        self.favicon = make_favicon()
+
+    def search(self, query):
+        stations = self.stations
+        for attribute in ('country', 'language', 'tag', 'name'):
+            value = query.get(attribute)
+            if value is None:
+                continue
+            value = value.lower()
+            key = 'tags' if attribute == 'tag' else attribute
+            if attribute == 'name':
+                stations = [station for station in stations if value in station[key].lower()]
+            else:
+                stations = [station for station in stations if value in station[key].lower().split(',')]
+        if query.get('order') == 'votes':
+            stations = sorted(stations, key=lambda station: station['votes'], reverse=True)
+        elif query.get('order') == 'name':
+            stations = sorted(stations, key=lambda station: station['name'].lower())
+        if query.get('limit'):
+            stations = stations[:int(query['limit'])]
+        return stations
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        fixtures = self.server.fixtures
+        parts = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        path = parts.path
+        if path.startswith('/favicons/'):
+            return self.send(fixtures.favicon, 'image/png')
+        if path in ('/json/countries', '/json/languages', '/json/tags'):
+            return self.send_json(getattr(fixtures, path[len('/json/'):]))
+        if path in ('/json/stations', '/json/stations/search'):
+            return self.send_json([self.localize(station) for station in fixtures.search(query)])
+        if path == '/json/stations/byuuid':
+            stations = [fixtures.by_uuid[uid] for uid in query.get('uuids', '').split(',') if uid in fixtures.by_uuid]
+            return self.send_json([self.localize(station) for station in stations])
+        if path.startswith('/json/url/'):
+            station = fixtures.by_uuid.get(path[len('/json/url/'):])
+            if station:
+                return self.send_json({'ok': True, 'message': 'retrieved station url', 'url': station['url']})
+        self.send(b'Not found', 'text/plain', 404)
+
+    def localize(self, station):
+        station = dict(station)
+        if station.get('favicon'):
+            station['favicon'] = 'http://%s:%d/favicons/%s.png' % (self.server.server_address[0],
+                                                                  self.server.server_address[1],
+                                                                  station['stationuuid'])
+        return station
+
+    def send_json(self, data):
+        self.send(json.dumps(data).encode(), 'application/json')
+
+    def send(self, body, content_type, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start(address='127.0.0.1', port=0):
+    server = ThreadingHTTPServer((address, port), StubHandler)
+    server.daemon_threads = True
+    server.fixtures = Fixtures()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def get_endpoint(server):
+    return 'http://%s:%d' % server.server_address
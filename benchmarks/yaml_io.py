@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Load and dump times of a large stations.yml with the pure Python and the libyaml (C) implementation, and with the
+binary sidecar cache used by generic.read_yaml_file.
+
+    python -m benchmarks.yaml_io [bookmarks]
+"""
+import sys
+import tempfile
+import time
+
+import yaml
+
+from ycast import generic
+
+
+def make_bookmarks(count):
+    bookmarks = {}
+    for i in range(count):
+        category = bookmarks.setdefault('Category %d' % (i % 50), {})
+        category['Station %d' % i] = 'http://stream.example.com/%d.mp3|http://www.example.com/%d.png' % (i, i)
+    return bookmarks
+
+
+def measure(name, function, runs=5):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    print("%-28s %8.2f ms" % (name, min(timings) * 1000))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    bookmarks = make_bookmarks(count)
+    generic.VAR_PATH = tempfile.mkdtemp(prefix='ycast-benchmark-')
+    generic.CACHE_PATH = generic.VAR_PATH + '/cache'
+    stations_file = generic.VAR_PATH + '/stations.yml'
+    generic.write_yaml_file(stations_file, bookmarks)
+    with open(stations_file) as f:
+        content = f.read()
+    print("stations.yml: %d bookmarks, %.1f KiB" % (count, len(content) / 1024))
+
+    measure('load (pure Python)', lambda: yaml.load(content, Loader=yaml.SafeLoader))
+    if hasattr(yaml, 'CSafeLoader'):
+        measure('load (libyaml)', lambda: yaml.load(content, Loader=yaml.CSafeLoader))
+    measure('dump (pure Python)', lambda: yaml.dump(bookmarks, Dumper=yaml.SafeDumper, sort_keys=False))
+    if hasattr(yaml, 'CSafeDumper'):
+        measure('dump (libyaml)', lambda: yaml.dump(bookmarks, Dumper=yaml.CSafeDumper, sort_keys=False))
+    # the first call parses the file and writes the sidecar, the following ones are served from it
+    generic.read_yaml_file(stations_file)
+    measure('read_yaml_file (sidecar)', lambda: generic.read_yaml_file(stations_file))
+
+
+if __name__ == '__main__':
+    main()
@@ -42,5 +42,5 @@ setup(
         'denon'
     ],
     install_requires=['requests', 'flask', 'PyYAML', 'Pillow'],
-    packages=find_packages(exclude=['contrib', 'docs', 'tests'])
+    packages=find_packages(exclude=['contrib', 'docs', 'tests', 'benchmarks'])
 )
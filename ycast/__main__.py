@@ -1,27 +1,74 @@
 #!/usr/bin/env python3
 
 import argparse
+import atexit
 import logging
 import sys
 import signal
+import threading
+import time
 
 from ycast import __version__
-from ycast import server
 
 logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=logging.INFO)
 
+# -c argument, applied again on reload
+stations_file = None
+
+
 def handler(signum, frame):
-    logging.info('Signal received: rereading filter config')
-    from ycast.my_filter import init_filter_file
-    init_filter_file()
+    logging.info('Signal received: reloading configuration')
+    try:
+        reload_config()
+    except Exception as ex:
+        logging.error("Could not reload configuration: %s", ex)
 signal.signal(signal.SIGHUP, handler)
+# exit normally on SIGTERM so the cache snapshot is written
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+
+def warm_up(start_time):
+    from ycast import my_stations, radiobrowser
+    my_stations.warm_up()
+    radiobrowser.warm_up()
+    logging.info("Caches warmed up, time to ready: %.1f s", time.time() - start_time)
+
+
+def reload_config():
+    """
+    Rereads the filters and limits (including the cache settings) and the stations file. The new configuration
+    replaces the old one as a whole, the results computed with the old one are dropped.
+    """
+    from ycast import generic, my_filter, my_stations, radiobrowser, stream_prober
+    filter_config = my_filter.init_filter_file()
+    generic.set_stations_file(stations_file)
+    my_stations.stations_index = None
+    radiobrowser.invalidate(filter_config)
+    stream_prober.reschedule()
+
+
+def init_database(file_name):
+    from ycast import generic, my_stations, my_recentlystation, sqlite_storage
+    sqlite_storage.init_database(file_name)
+    atexit.register(sqlite_storage.close_database)
+    if sqlite_storage.is_empty():
+        logging.info("Importing bookmarks and recently played stations into %s", file_name)
+        my_stations.import_yaml_file(generic.get_stations_file())
+        my_recentlystation.import_yaml_file(generic.get_recently_file())
+
 
 def launch_server():
+    start_time = time.time()
     parser = argparse.ArgumentParser(description='vTuner API emulation')
     parser.add_argument('-c', action='store', dest='config', help='Station configuration', default=None)
     parser.add_argument('-l', action='store', dest='address', help='Listen address', default='0.0.0.0')
     parser.add_argument('-p', action='store', dest='port', type=int, help='Listen port', default=80)
     parser.add_argument('-d', action='store_true', dest='debug', help='Enable debug logging')
+    parser.add_argument('-w', action='store_true', dest='warm_up', help='Warm up caches in the background at startup')
+    parser.add_argument('-s', action='store', dest='database', default=None,
+                        help='SQLite database for bookmarks and recently played stations')
+    parser.add_argument('-r', action='store_true', dest='relay',
+                        help='Play streams through YCast, one connection per station shared by all receivers')
     arguments = parser.parse_args()
     logging.info("YCast (%s) server starting", __version__)
     if arguments.debug:
@@ -35,7 +82,26 @@ def launch_server():
     init_base_dir('/.ycast')
     from ycast.my_filter import init_filter_file
     init_filter_file()
+    global stations_file
+    stations_file = arguments.config
+    from ycast.generic import set_stations_file
+    set_stations_file(stations_file)
+    if arguments.database:
+        init_database(arguments.database)
+
+    from ycast import radiobrowser, my_devices
+    radiobrowser.restore_snapshot()
+    atexit.register(radiobrowser.save_snapshot)
+    my_devices.start_flusher()
+    atexit.register(my_devices.flush)
+    from ycast import stream_prober
+    stream_prober.start()
+    if arguments.warm_up:
+        threading.Thread(target=warm_up, args=(start_time,), daemon=True).start()
 
+    # Flask is only loaded once the arguments are valid
+    from ycast import server
+    server.station_relay = arguments.relay
     server.run(arguments.config, arguments.address, arguments.port)
 
 
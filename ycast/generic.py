@@ -1,10 +1,27 @@
 import logging
+import marshal
 import os
 import hashlib
 import sys
+import tempfile
+import threading
+import time
+from sys import intern
 
 import yaml
 
+import ycast.vtuner as vtuner
+from ycast import tracing
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# the libyaml bindings are much faster, fall back to the pure Python implementation without them
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+SIDECAR_CACHE_NAME = 'yaml'
 
 USER_AGENT = 'YCast'
 
@@ -12,6 +29,10 @@ USER_AGENT = 'YCast'
 VAR_PATH = ''
 CACHE_PATH = ''
 stations_file_by_config = ''
+# directories known to exist, saves a makedirs call on every request
+created_dirs = set()
+state_files = {}
+state_files_lock = threading.Lock()
 
 
 class Directory:
@@ -27,6 +48,212 @@ class Directory:
         return {'name': self.name , 'displayname': self.displayname, 'count': self.item_count }
 
 
+class DirectoryIndex:
+    """
+    Directories sorted by display name and grouped by their first letter, built once per refresh and only read
+    afterwards. 'names' maps a directory to the upstream names merged into it.
+    """
+
+    def __init__(self, directories, names=None):
+        self.directories = sorted(directories, key=lambda directory: directory.displayname.lower())
+        self.names = names or {}
+        self.buckets = {}
+        for directory in self.directories:
+            self.buckets.setdefault(get_bucket(directory.displayname), []).append(directory)
+
+    def __len__(self):
+        return len(self.directories)
+
+    def get_names(self, name):
+        return self.names.get(name, [name])
+
+
+def get_bucket(name):
+    letter = name[:1].upper()
+    if letter.isascii() and letter.isalpha():
+        return letter
+    return '#'
+
+
+class Station:
+    """
+    Immutable station record shared by the Radiobrowser and 'My Stations' backends.
+    Slots keep the per-station footprint small on large listings, the highly repetitive codec, country and
+    language values are interned and the genre is only derived from the description when it is needed.
+    """
+    __slots__ = ('id', 'name', 'url', 'icon', 'description', 'countrycode', 'language', 'languagecodes',
+                 'codec', 'bitrate', 'votes', 'uuid', '_genre')
+
+    def __init__(self, uid, name, url, icon=None, description=None, countrycode=None, language=None,
+                 languagecodes=None, codec=None, bitrate=None, votes=None, uuid=None, genre=None):
+        set_slot = object.__setattr__
+        set_slot(self, 'id', uid)
+        set_slot(self, 'name', name)
+        set_slot(self, 'url', url)
+        set_slot(self, 'icon', icon)
+        set_slot(self, 'description', description)
+        set_slot(self, 'countrycode', intern_attr(countrycode))
+        set_slot(self, 'language', intern_attr(language))
+        set_slot(self, 'languagecodes', intern_attr(languagecodes))
+        set_slot(self, 'codec', intern_attr(codec))
+        set_slot(self, 'bitrate', bitrate)
+        set_slot(self, 'votes', votes)
+        set_slot(self, 'uuid', uuid)
+        set_slot(self, '_genre', genre)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Station records are immutable, use replace()")
+
+    def __delattr__(self, name):
+        raise AttributeError("Station records are immutable")
+
+    @property
+    def tags(self):
+        if not self.description:
+            return []
+        return self.description.split(',')
+
+    @property
+    def genre(self):
+        if self._genre is None and self.description:
+            object.__setattr__(self, '_genre', self.description.split(',', 1)[0])
+        return self._genre
+
+    def __reduce__(self):
+        return restore_station, (type(self), tuple(getattr(self, slot) for slot in Station.__slots__))
+
+    def replace(self, **changes):
+        station = object.__new__(type(self))
+        for slot in Station.__slots__:
+            object.__setattr__(station, slot, changes.get(slot, getattr(self, slot)))
+        return station
+
+    def to_vtuner(self):
+        return vtuner.Station(self)
+
+    def to_dict(self):
+        return {'name': self.name , 'url': self.url, 'icon': self.icon, 'description': self.description }
+
+
+def restore_station(station_class, values):
+    station = object.__new__(station_class)
+    for slot, value in zip(Station.__slots__, values):
+        object.__setattr__(station, slot, value)
+    return station
+
+
+def intern_attr(value):
+    if isinstance(value, str):
+        return intern(value)
+    return value
+
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls with the same key into one in-flight call whose result (or exception) is
+    shared by every caller waiting for it. Results are not kept after the call has finished.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, function, *args):
+        with self._lock:
+            self.calls += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+            else:
+                self.coalesced += 1
+        if not leader:
+            logging.debug("%s: waiting for in-flight call '%s'", self.name, key)
+            flight.done.wait()
+            if flight.error:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = function(*args)
+            return flight.result
+        except Exception as ex:
+            flight.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing service: after <failure_threshold> failures in a row calls are refused for
+    <reset_timeout> seconds, then a single trial call decides whether the circuit closes or opens again.
+    """
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self.last_success = None
+        self.last_failure = None
+        self.last_error = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened is None:
+                return True
+            if self.trial or time.time() - self.opened < self.reset_timeout:
+                return False
+            self.trial = True
+            return True
+
+    def succeeded(self):
+        with self._lock:
+            if self.opened is not None:
+                logging.info("%s available again", self.name)
+            self.failures = 0
+            self.opened = None
+            self.trial = False
+            self.last_success = time.time()
+
+    def failed(self, error):
+        with self._lock:
+            self.failures += 1
+            self.trial = False
+            self.last_failure = time.time()
+            self.last_error = str(error)
+            if self.opened is not None or self.failures >= self.failure_threshold:
+                if self.opened is None:
+                    logging.warning("%s failed %d times, not called for %d s", self.name, self.failures,
+                                    self.reset_timeout)
+                self.opened = self.last_failure
+
+    def get_state(self):
+        with self._lock:
+            if self.opened is None:
+                return 'closed'
+            if self.trial or time.time() - self.opened >= self.reset_timeout:
+                return 'half-open'
+            return 'open'
+
+    def to_dict(self):
+        return {'state': self.get_state(), 'failures': self.failures, 'last_success': self.last_success,
+                'last_failure': self.last_failure, 'last_error': self.last_error}
+
 
 def mk_writeable_dir(path):
     try:
@@ -41,25 +268,27 @@ def mk_writeable_dir(path):
 
 def init_base_dir(path_element):
     global VAR_PATH, CACHE_PATH
+    home_dir = os.path.expanduser("~")
+    work_dir = os.getcwd()
     logging.info('Initialize base directory %s', path_element)
-    logging.debug('    HOME: %s',os.path.expanduser("~"))
-    logging.debug('     PWD: %s',os.getcwd())
+    logging.debug('    HOME: %s', home_dir)
+    logging.debug('     PWD: %s', work_dir)
     var_dir = None
 
-    if not os.getcwd().endswith('/ycast'):
+    if not work_dir.endswith('/ycast'):
         # specified working dir with /ycast has prio
-        try_path = os.path.expanduser("~") + path_element
+        try_path = home_dir + path_element
         logging.info('   try Home-Dir: %s', try_path)
         var_dir = mk_writeable_dir(try_path)
 
     if var_dir is None:
         # avoid using root '/' and it's subdir
-        if len(os.getcwd()) < 6:
-            logging.error("   len(PWD) < 6 (PWD is too small) < 6: '%s'", os.getcwd())
+        if len(work_dir) < 6:
+            logging.error("   len(PWD) < 6 (PWD is too small) < 6: '%s'", work_dir)
         else:
-            try_path = os.getcwd() + path_element
+            try_path = work_dir + path_element
             logging.info('   try Work-Dir: %s', try_path)
-            var_dir = mk_writeable_dir(os.getcwd() + path_element)
+            var_dir = mk_writeable_dir(try_path)
         if var_dir is None:
             sys.exit('YCast: ###### No usable directory found #######, I give up....')
     logging.info('using var directory: %s', var_dir)
@@ -96,6 +325,8 @@ def get_cache_path(cache_name):
     cache_path = CACHE_PATH
     if cache_name:
         cache_path = CACHE_PATH + '/' + cache_name
+    if cache_path in created_dirs:
+        return cache_path
     try:
         os.makedirs(cache_path)
     except FileExistsError:
@@ -103,10 +334,13 @@ def get_cache_path(cache_name):
     except PermissionError:
         logging.error("Could not create cache folders (%s) because of access permissions", cache_path)
         return None
+    created_dirs.add(cache_path)
     return cache_path
 
 
 def get_var_path():
+    if VAR_PATH in created_dirs:
+        return VAR_PATH
     try:
         os.makedirs(VAR_PATH)
     except FileExistsError:
@@ -114,6 +348,7 @@ def get_var_path():
     except PermissionError:
         logging.error("Could not create cache folders (%s) because of access permissions", VAR_PATH)
         return None
+    created_dirs.add(VAR_PATH)
     return VAR_PATH
 
 
@@ -138,6 +373,15 @@ def set_stations_file(stations_file):
         stations_file_by_config = stations_file
 
 
+def get_file_signature(file_name):
+    # changes whenever the file is modified, replaced (atomic writes create a new inode) or removed
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
 def get_checksum(feed, charlimit=12):
     hash_feed = feed.encode()
     hash_object = hashlib.md5(hash_feed)
@@ -150,29 +394,209 @@ def get_checksum(feed, charlimit=12):
 
 
 def read_yaml_file(file_name):
+    with tracing.span('read_yaml_file'):
+        signature = get_file_signature(file_name)
+        sidecar_file = get_sidecar_file(file_name)
+        if signature and sidecar_file:
+            cached = read_sidecar_file(sidecar_file, signature)
+            if cached is not None:
+                return cached[0]
+        try:
+            with open(file_name, 'r') as f:
+                dictionary = yaml.load(f, Loader=YAML_LOADER)
+        except FileNotFoundError:
+            logging.warning("YAML file '%s' not found", file_name)
+            remove_sidecar_file(file_name)
+            return None
+        except yaml.YAMLError as e:
+            logging.error("YAML format error in '%s':\n    %s", file_name, e)
+            return None
+        if signature and sidecar_file:
+            write_sidecar_file(sidecar_file, signature, dictionary)
+        return dictionary
+
+
+def get_sidecar_file(file_name):
+    """
+    Binary snapshot of a parsed YAML file in the cache directory, valid as long as modification time and size of
+    the YAML file are unchanged.
+    """
+    if not CACHE_PATH:
+        return None
+    cache_path = get_cache_path(SIDECAR_CACHE_NAME)
+    if not cache_path:
+        return None
+    return cache_path + '/' + get_checksum(os.path.realpath(file_name)) + '.marshal'
+
+
+def read_sidecar_file(sidecar_file, signature):
     try:
-        with open(file_name, 'r') as f:
-            return yaml.safe_load(f)
-    except FileNotFoundError:
-        logging.warning("YAML file '%s' not found", file_name)
-    except yaml.YAMLError as e:
-        logging.error("YAML format error in '%':\n    %s", file_name, e)
-    return None
+        with open(sidecar_file, 'rb') as f:
+            version, sidecar_signature, dictionary = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if version != sys.hexversion or tuple(sidecar_signature) != signature:
+        return None
+    return (dictionary,)
 
 
-def write_yaml_file(file_name, dictionary):
+def write_sidecar_file(sidecar_file, signature, dictionary):
     try:
-        with open(file_name, 'w') as f:
-            # no sort please
-            yaml.dump(dictionary, f, sort_keys=False)
-            return True
+        data = marshal.dumps((sys.hexversion, signature, dictionary))
+    except ValueError:
+        # not a plain YAML document
+        return
+    try:
+        fd, temp_name = tempfile.mkstemp(dir=os.path.dirname(sidecar_file), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_name, sidecar_file)
+    except OSError as ex:
+        logging.debug("YAML sidecar cache not written '%s': %s", sidecar_file, ex)
+
+
+def remove_sidecar_file(file_name):
+    # called when the YAML file is written or gone, a stale snapshot is not kept around
+    sidecar_file = get_sidecar_file(file_name)
+    if sidecar_file:
+        try:
+            os.remove(sidecar_file)
+        except OSError:
+            pass
+
+
+def write_yaml_file(file_name, dictionary, wait=True):
+    """
+    Writes a state file atomically. With wait=False the call returns immediately while another thread is
+    writing the same file, that thread then writes this content as well (only the latest content is written).
+    """
+    return get_state_file(file_name).write(dictionary, wait)
+
+
+def get_state_file(file_name):
+    file_name = os.path.realpath(file_name)
+    with state_files_lock:
+        state_file = state_files.get(file_name)
+        if state_file is None:
+            state_file = state_files[file_name] = StateFile(file_name)
+        return state_file
+
+
+class StateFile:
+    def __init__(self, file_name):
+        self.file_name = file_name
+        # held while writing to disk
+        self.write_lock = threading.Lock()
+        # protects the pending content and the generation counters
+        self.pending_lock = threading.Lock()
+        self.pending = None
+        self.pending_generation = 0
+        self.written_generation = 0
+        self.writes = 0
+        self.result = True
+
+    def write(self, dictionary, wait=True):
+        with self.pending_lock:
+            self.pending_generation += 1
+            self.pending = dictionary
+        while True:
+            if not self.write_lock.acquire(blocking=wait):
+                # the writing thread picks up our content when it is done
+                return True
+            try:
+                self.write_pending()
+            finally:
+                self.write_lock.release()
+            with self.pending_lock:
+                # content may have been queued after the last write while we still held the lock
+                if self.written_generation >= self.pending_generation:
+                    return self.result
+
+    def write_pending(self):
+        while True:
+            with self.pending_lock:
+                if self.written_generation >= self.pending_generation:
+                    return
+                dictionary = self.pending
+                generation = self.pending_generation
+                self.pending = None
+            self.result = write_yaml_file_atomic(self.file_name, dictionary)
+            self.writes += 1
+            with self.pending_lock:
+                self.written_generation = generation
+
+
+def write_yaml_file_atomic(file_name, dictionary):
+    try:
+        # no sort please
+        content = yaml.dump(dictionary, Dumper=YAML_DUMPER, sort_keys=False)
     except yaml.YAMLError as e:
-        logging.error("YAML format error in '%':\n    %s", file_name, e)
+        logging.error("YAML format error in '%s':\n    %s", file_name, e)
+        return False
+    directory = os.path.dirname(file_name)
+    temp_name = None
+    try:
+        with FileLock(file_name):
+            try:
+                mode = os.stat(file_name).st_mode & 0o777
+            except FileNotFoundError:
+                mode = 0o644
+            fd, temp_name = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(file_name) + '.',
+                                             suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(temp_name, mode)
+            os.replace(temp_name, file_name)
+            temp_name = None
+            fsync_dir(directory)
+            remove_sidecar_file(file_name)
+        return True
     except Exception as ex:
         logging.error("File not written '%s':\n    %s", file_name, ex)
+    finally:
+        if temp_name:
+            try:
+                os.remove(temp_name)
+            except OSError:
+                pass
     return False
 
 
+class FileLock:
+    """Inter-process lock for a state file, held on a separate lock file because the state file is replaced."""
+    def __init__(self, file_name):
+        self.lock_file_name = os.path.join(os.path.dirname(file_name), '.' + os.path.basename(file_name) + '.lock')
+        self.fd = None
+
+    def __enter__(self):
+        if fcntl:
+            self.fd = os.open(self.lock_file_name, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+        return False
+
+
+def fsync_dir(directory):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
 def readlns_txt_file(file_name):
     try:
         with open(file_name, 'r') as f:
@@ -0,0 +1,104 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from ycast import metrics
+from ycast.my_filter import get_limit
+
+# seconds a call waits for a free slot before it is rejected
+MAX_WAIT = 2.0
+
+
+class Busy(Exception):
+    pass
+
+
+class Limiter:
+    """
+    Allows at most <concurrency limit> calls at the same time and starts at most <rate limit> calls per second
+    (token bucket, bursts up to one second worth of calls). The limits are read on every call, 0 disables them.
+    Calls that can not start within MAX_WAIT seconds raise Busy.
+    """
+
+    def __init__(self, name, concurrency_limit, rate_limit=None):
+        self.name = name
+        self.concurrency_limit = concurrency_limit
+        self.rate_limit = rate_limit
+        self.condition = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.tokens = None
+        self.refilled = time.monotonic()
+
+    def get_rate(self):
+        return get_limit(self.rate_limit) if self.rate_limit else 0
+
+    def refill(self, now):
+        rate = self.get_rate()
+        if self.tokens is None:
+            self.tokens = float(rate)
+        self.tokens = min(float(rate), self.tokens + (now - self.refilled) * rate)
+        self.refilled = now
+
+    def try_acquire(self, now):
+        """Returns 0 if the call can start, the seconds until it could or None if it has to wait for a release."""
+        concurrency = get_limit(self.concurrency_limit)
+        if concurrency and self.active >= concurrency:
+            return None
+        rate = self.get_rate()
+        if rate:
+            self.refill(now)
+            if self.tokens < 1:
+                return (1 - self.tokens) / rate
+            self.tokens -= 1
+        self.active += 1
+        return 0
+
+    def acquire(self, timeout=MAX_WAIT):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                wait = self.try_acquire(now)
+                if wait == 0:
+                    return True
+                remaining = deadline - now
+                if remaining <= 0 or (wait is not None and wait > remaining):
+                    self.rejected += 1
+                    logging.warning("%s busy, call rejected", self.name)
+                    return False
+                self.waiting += 1
+                try:
+                    self.condition.wait(remaining if wait is None else wait)
+                finally:
+                    self.waiting -= 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    @contextmanager
+    def limit(self):
+        if not self.acquire():
+            raise Busy(self.name)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+upstream = Limiter('Radiobrowser', 'UPSTREAM_CONCURRENCY', 'UPSTREAM_RATE')
+favicons = Limiter('Favicon downloads', 'FAVICON_CONCURRENCY', 'FAVICON_RATE')
+images = Limiter('Image conversion', 'IMAGE_CONCURRENCY')
+limiters = (upstream, favicons, images)
+
+queue_depth = metrics.CallbackMetric('ycast_limiter_waiting', 'Calls waiting for a limiter.', ('limiter',),
+                                     lambda: {(limiter.name,): limiter.waiting for limiter in limiters})
+active_calls = metrics.CallbackMetric('ycast_limiter_active', 'Calls running under a limiter.', ('limiter',),
+                                      lambda: {(limiter.name,): limiter.active for limiter in limiters})
+rejected_calls = metrics.CallbackMetric('ycast_limiter_rejected_total', 'Calls rejected by a limiter.',
+                                        ('limiter',),
+                                        lambda: {(limiter.name,): limiter.rejected for limiter in limiters}, 'counter')
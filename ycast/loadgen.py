@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Load generator emulating a fleet of vTuner AVR clients browsing a running YCast instance.
+
+    python -m ycast.loadgen http://localhost:8010 -c 20 -d 60
+"""
+import argparse
+import html
+import random
+import re
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+AVR_PATH = '/setupapp/yamaha/asp/browsexml/'
+PAGE_SIZE = 8
+# letter and range sub-directories YCast splits long lists into
+BUCKET_URL = re.compile(r'[?&]letter=')
+
+
+def get_directories(xml):
+    return [html.unescape(url) for url in re.findall(r'<UrlDir>([^<]*)</UrlDir>', xml)]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.errors = {}
+
+    def add(self, kind, elapsed, failed):
+        with self.lock:
+            self.timings.setdefault(kind, []).append(elapsed)
+            if failed:
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def report(self, elapsed):
+        total = sum(len(values) for values in self.timings.values())
+        errors = sum(self.errors.values())
+        lines = ["%d requests in %.1f s (%.1f req/s), %d errors (%.2f %%)" %
+                 (total, elapsed, total / elapsed, errors, 100.0 * errors / total if total else 0),
+                 "%-10s %7s %7s %9s %9s %9s %9s" % ('request', 'count', 'errors', 'p50 ms', 'p90 ms', 'p99 ms',
+                                                     'max ms')]
+        for kind, values in sorted(self.timings.items()):
+            lines.append("%-10s %7d %7d %9.1f %9.1f %9.1f %9.1f" %
+                         (kind, len(values), self.errors.get(kind, 0), percentile(values, 0.5) * 1000,
+                          percentile(values, 0.9) * 1000, percentile(values, 0.99) * 1000, max(values) * 1000))
+        return '\n'.join(lines)
+
+
+class AvrClient:
+    def __init__(self, base_url, number, stats, host_header=None, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.mac = '%012x' % (0x00a0de000000 + number)
+        self.stats = stats
+        self.timeout = timeout
+        self.random = random.Random(number)
+        self.session = requests.Session()
+        if host_header:
+            self.session.headers['Host'] = host_header
+
+    def get(self, kind, url, avr_parameters=True, start_item=None):
+        # links in the returned XML point to the host the AVR thinks it talks to
+        parts = urlsplit(url)
+        url = self.base_url + parts.path + ('?' + parts.query if parts.query else '')
+        if avr_parameters:
+            # AVRs blindly append their parameters with an ampersand
+            url += '&mac=%s&dlang=eng&fver=1.2' % self.mac
+            if start_item is not None:
+                url += '&startitems=%d&enditems=%d' % (start_item, start_item + PAGE_SIZE - 1)
+        start = time.perf_counter()
+        try:
+            response = self.session.get(url, timeout=self.timeout, allow_redirects=False)
+            body = response.content
+            failed = response.status_code >= 400
+        except requests.exceptions.RequestException:
+            body = b''
+            failed = True
+        self.stats.add(kind, time.perf_counter() - start, failed)
+        return body.decode('utf-8', 'replace')
+
+    def get_page(self, kind, url, start_item=1):
+        xml = self.get(kind, url, start_item=start_item)
+        for icon in re.findall(r'<Logo>([^<]*)</Logo>', xml):
+            self.get('icon', icon, avr_parameters=False)
+        return xml
+
+    def open_buckets(self, kind, url, xml):
+        """Descends into the letter and range sub-directories of a long list, returns its entries page."""
+        directories = get_directories(xml)
+        while directories and all(BUCKET_URL.search(directory) for directory in directories):
+            url = self.random.choice(directories)
+            xml = self.get_page(kind, url)
+            directories = get_directories(xml)
+        return url, xml
+
+    def bootstrap(self):
+        self.get('login', AVR_PATH + 'loginXML.asp?token=0', avr_parameters=False)
+        return self.get_page('login', AVR_PATH + 'loginXML.asp?vtuner=true')
+
+    def browse(self):
+        xml = self.get_page('nav', AVR_PATH + 'navXML.asp?vtuner=true')
+        directories = get_directories(xml)
+        if not directories:
+            return
+        directory_url = self.random.choice(directories)
+        directory_url, xml = self.open_buckets('directory', directory_url, self.get_page('directory', directory_url))
+        directories = get_directories(xml)
+        if directories:
+            # a directory listing: open one entry and walk a few pages of it
+            station_list_url = self.random.choice(directories)
+            station_list_url, xml = self.open_buckets('stations', station_list_url,
+                                                      self.get_page('stations', station_list_url))
+            for page in range(1, self.random.randint(1, 3)):
+                xml = self.get_page('stations', station_list_url, page * PAGE_SIZE + 1)
+        station_ids = re.findall(r'<StationId>([^<]*)</StationId>', xml)
+        if station_ids:
+            station_id = self.random.choice(station_ids)
+            self.get('station', AVR_PATH + 'statxml.asp?vtuner=true&id=' + station_id)
+            self.get('play', '/ycast/play?id=' + station_id, avr_parameters=False)
+
+    def run(self, deadline, think_time):
+        self.bootstrap()
+        while time.time() < deadline:
+            self.browse()
+            if think_time:
+                time.sleep(self.random.uniform(0, think_time))
+
+
+def run(base_url, concurrency, duration, think_time=0.0, host_header=None):
+    stats = Stats()
+    deadline = time.time() + duration
+    clients = [AvrClient(base_url, number, stats, host_header) for number in range(concurrency)]
+    threads = [threading.Thread(target=client.run, args=(deadline, think_time), daemon=True) for client in clients]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return stats, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Emulate a fleet of AVRs browsing a YCast instance')
+    parser.add_argument('url', help='Base URL of the YCast instance, e.g. http://localhost:8010')
+    parser.add_argument('-c', action='store', dest='concurrency', type=int, default=10,
+                        help='Number of concurrent AVRs')
+    parser.add_argument('-d', action='store', dest='duration', type=float, default=30, help='Duration in seconds')
+    parser.add_argument('-t', action='store', dest='think_time', type=float, default=1.0,
+                        help='Maximum pause between two browsing walks of an AVR in seconds')
+    parser.add_argument('-H', action='store', dest='host_header', default=None,
+                        help='Host header to send, e.g. radioyamaha.vtuner.com')
+    arguments = parser.parse_args()
+    stats, elapsed = run(arguments.url, arguments.concurrency, arguments.duration, arguments.think_time,
+                         arguments.host_header)
+    print(stats.report(elapsed))
+    if not stats.timings.get('icon') or not stats.timings.get('play'):
+        # the walks never reached a station list, the numbers are not comparable to other runs
+        sys.exit("No station reached: no icon or play requests were made")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+import threading
+import time
+from contextlib import contextmanager
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+registry = []
+
+
+class Metric:
+    metric_type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        registry.append(self)
+
+    def label_values(self, labels):
+        return tuple(str(labels.get(labelname, '')) for labelname in self.labelnames)
+
+    def header(self):
+        return ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.metric_type)]
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, label_values, value) for label_values, value in self._values.items()]
+
+    def to_text(self):
+        lines = self.header()
+        for name, label_values, value in self.samples():
+            lines.append(name + format_labels(self.labelnames, label_values) + ' ' + format_value(value))
+        return lines
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class CallbackMetric(Metric):
+    """Metric whose values are read from a callback returning {label values tuple: value} on every scrape."""
+
+    def __init__(self, name, documentation, labelnames, callback, metric_type='gauge'):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+        self.metric_type = metric_type
+
+    def samples(self):
+        return [(self.name, label_values, value) for label_values, value in self.callback().items()]
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.label_values(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # one count per bucket, followed by the overall count and sum
+                state = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += 1
+            state[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def to_text(self):
+        lines = self.header()
+        labelnames = self.labelnames + ('le',)
+        with self._lock:
+            values = [(label_values, list(state)) for label_values, state in self._values.items()]
+        for label_values, state in values:
+            for bound, count in zip(self.buckets, state):
+                lines.append(self.name + '_bucket' + format_labels(labelnames, label_values + (format_value(bound),))
+                             + ' ' + format_value(count))
+            lines.append(self.name + '_bucket' + format_labels(labelnames, label_values + ('+Inf',))
+                         + ' ' + format_value(state[-2]))
+            lines.append(self.name + '_count' + format_labels(self.labelnames, label_values)
+                         + ' ' + format_value(state[-2]))
+            lines.append(self.name + '_sum' + format_labels(self.labelnames, label_values)
+                         + ' ' + format_value(state[-1]))
+        return lines
+
+
+def format_labels(labelnames, label_values):
+    if not labelnames:
+        return ''
+    return '{' + ','.join('%s="%s"' % (labelname, escape_label_value(label_value))
+                          for labelname, label_value in zip(labelnames, label_values)) + '}'
+
+
+def escape_label_value(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def to_text():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.to_text())
+    return '\n'.join(lines) + '\n'
+
+
+http_requests = Counter('ycast_http_requests_total', 'HTTP requests by Flask route.',
+                        ('route', 'method', 'status'))
+http_request_duration = Histogram('ycast_http_request_duration_seconds', 'HTTP request latency by Flask route.',
+                                  ('route',))
+upstream_request_duration = Histogram('ycast_upstream_request_duration_seconds',
+                                      'Radiobrowser API latency by endpoint, station lists until their headers.',
+                                      ('endpoint',))
+upstream_errors = Counter('ycast_upstream_errors_total', 'Failed Radiobrowser API requests by endpoint.',
+                          ('endpoint',))
+icon_cache_requests = Counter('ycast_icon_cache_requests_total', 'Station icon cache lookups.', ('result',))
+icon_cache_hit_ratio = CallbackMetric('ycast_icon_cache_hit_ratio', 'Share of station icons served from the cache.',
+                                      (), lambda: {(): hit_ratio(icon_cache_requests)})
+filter_checks = Counter('ycast_filter_checks_total', 'Stations checked against the filters.')
+filter_rejections = Counter('ycast_filter_rejections_total', 'Stations rejected by the filters by parameter.',
+                            ('parameter',))
+recently_write_duration = Histogram('ycast_recently_write_duration_seconds',
+                                    'Time to write the recently played stations file.')
+single_flights = []
+stream_probes = Counter('ycast_stream_probes_total', 'Stream URLs checked by the background prober by result.',
+                        ('result',))
+coalesced_calls = CallbackMetric('ycast_coalesced_calls_total',
+                                 'Upstream calls served by an identical in-flight call.', ('flight',),
+                                 lambda: {(flight.name,): flight.coalesced for flight in single_flights}, 'counter')
+
+
+def hit_ratio(counter):
+    with counter._lock:
+        hits = counter._values.get(('hit',), 0)
+        total = hits + counter._values.get(('miss',), 0)
+    if not total:
+        return 0.0
+    return hits / total
+
+
+def register_single_flight(flight):
+    single_flights.append(flight)
+    return flight
@@ -0,0 +1,152 @@
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import ycast.generic as generic
+
+# profiles held in memory, the least recently used one is saved and dropped beyond this
+MAX_DEVICES = 128
+MAX_ADDRESSES = 256
+FLUSH_INTERVAL = 30
+DEVICES_DIR = 'devices'
+
+devices = OrderedDict()
+# remote address -> MAC, for requests without mac parameter (e.g. icons)
+addresses = OrderedDict()
+devices_lock = threading.Lock()
+
+
+class Device:
+    """
+    Per-receiver state, stored in <var>/devices/<mac>.yml:
+        recently: {<directory>: {<name>: url|icon|vote}}   same format as recently.yml
+        bookmarks: {<category>: {<name>: url|icon}}       same format as stations.yml, overlays 'My Stations'
+    """
+
+    def __init__(self, mac):
+        self.mac = mac
+        self.dirty = False
+        self.categories = None
+        # (categories, stations by category), built by my_stations
+        self.stations = None
+        # my_recentlystation.Ranking of the recently played stations
+        self.ranking = None
+        device_file = get_device_file(mac)
+        profile = generic.read_yaml_file(device_file) if device_file else None
+        profile = profile or {}
+        self.recently = profile.get('recently')
+        self.bookmarks = profile.get('bookmarks')
+
+    def set_recently(self, station_dict):
+        self.recently = station_dict
+        self.categories = None
+        self.dirty = True
+
+    def get_categories(self):
+        """Categories of this device, they replace 'My Stations' categories with the same name."""
+        categories = self.categories
+        if categories is None:
+            categories = {}
+            if self.bookmarks:
+                categories.update(self.bookmarks)
+            if self.recently:
+                categories.update(self.recently)
+            self.categories = categories
+        return categories
+
+    def to_dict(self):
+        profile = {}
+        if self.recently:
+            profile['recently'] = self.recently
+        if self.bookmarks:
+            profile['bookmarks'] = self.bookmarks
+        return profile
+
+    def save(self):
+        self.dirty = False
+        device_file = get_device_file(self.mac)
+        if device_file:
+            generic.write_yaml_file(device_file, self.to_dict())
+
+
+def normalize_mac(mac):
+    if not mac:
+        return None
+    mac = mac.replace(':', '').replace('-', '').lower()
+    if not re.fullmatch('[0-9a-z]{1,64}', mac):
+        return None
+    return mac
+
+
+def get_device_file(mac):
+    # like the other state files: without a writeable directory the profile is only kept in memory
+    devices_path = get_devices_path()
+    if not devices_path:
+        return None
+    return devices_path + '/' + mac + '.yml'
+
+
+def get_devices_path():
+    var_path = generic.get_var_path()
+    if not var_path:
+        return None
+    devices_path = var_path + '/' + DEVICES_DIR
+    if devices_path not in generic.created_dirs:
+        if not generic.mk_writeable_dir(devices_path):
+            return None
+        generic.created_dirs.add(devices_path)
+    return devices_path
+
+
+def get_device(mac):
+    with devices_lock:
+        device = devices.get(mac)
+        if device is not None:
+            devices.move_to_end(mac)
+            return device
+    # loaded outside of the lock, a concurrent load of the same device is harmless
+    device = Device(mac)
+    with devices_lock:
+        device = devices.setdefault(mac, device)
+        devices.move_to_end(mac)
+        while len(devices) > MAX_DEVICES:
+            evicted_device = devices.popitem(last=False)[1]
+            # saved before the lock is released, a request for it loads it from disk only after that
+            if evicted_device.dirty:
+                evicted_device.save()
+    return device
+
+
+def get_mac(mac, address):
+    """MAC of the request, remembered per remote address for requests without it."""
+    mac = normalize_mac(mac)
+    with devices_lock:
+        if mac:
+            if addresses.get(address) != mac:
+                addresses[address] = mac
+                if len(addresses) > MAX_ADDRESSES:
+                    addresses.popitem(last=False)
+            return mac
+        return addresses.get(address)
+
+
+def flush():
+    with devices_lock:
+        dirty_devices = [device for device in devices.values() if device.dirty]
+    for device in dirty_devices:
+        device.save()
+    if dirty_devices:
+        logging.debug("Saved %d device profiles", len(dirty_devices))
+
+
+def start_flusher(interval=FLUSH_INTERVAL):
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                flush()
+            except Exception as ex:
+                logging.error("Could not save device profiles: %s", ex)
+    threading.Thread(target=run, name='device-flusher', daemon=True).start()
@@ -1,47 +1,109 @@
+import copy
+import json
 import logging
+import threading
+from contextlib import contextmanager
+from types import MappingProxyType
 
-from ycast import generic
+from ycast import generic, metrics
 from ycast.generic import get_json_attr
 
-white_list = {'lastcheckok': 1}
-black_list = {}
-limit_list = {}
-limit_defs_int ={ 'MINIMUM_COUNT_GENRE' : 40, 'MINIMUM_COUNT_COUNTRY' : 5, 'MINIMUM_COUNT_LANGUAGE' : 5, 'DEFAULT_STATION_LIMIT' : 200}
-limit_defs_bool ={ 'SHOW_BROKEN_STATIONS' : False}
+DEFAULT_WHITE_LIST = {'lastcheckok': 1}
+limit_defs_int ={ 'MINIMUM_COUNT_GENRE' : 40, 'MINIMUM_COUNT_COUNTRY' : 5, 'MINIMUM_COUNT_LANGUAGE' : 5, 'DEFAULT_STATION_LIMIT' : 200, 'SLOW_REQUEST_MS' : 2000, 'CACHE_TTL' : 3600, 'CACHE_STATIONS' : 20000, 'VOTE_HALF_LIFE' : 20, 'PROBE_INTERVAL' : 1800, 'BUCKET_THRESHOLD' : 50, 'UPSTREAM_CONCURRENCY' : 4, 'UPSTREAM_RATE' : 10, 'FAVICON_CONCURRENCY' : 8, 'FAVICON_RATE' : 20, 'IMAGE_CONCURRENCY' : 2}
+# these may be set to 0 to disable the probing or a concurrency or rate limit
+limit_defs_zero = ('PROBE_INTERVAL', 'UPSTREAM_CONCURRENCY', 'UPSTREAM_RATE', 'FAVICON_CONCURRENCY', 'FAVICON_RATE',
+                   'IMAGE_CONCURRENCY')
+limit_defs_bool ={ 'SHOW_BROKEN_STATIONS' : False, 'HIDE_DEAD_STATIONS' : False}
 parameter_failed_list = {}
 count_used = 0
 count_hit = 0
 
+
+class FilterConfig:
+    """
+    Filters and limits as read-only mappings. A configuration is never modified, set_config() replaces it as
+    a whole, so readers never see a partly updated one.
+    """
+    __slots__ = ('white_list', 'black_list', 'limit_list', 'fingerprint')
+
+    def __init__(self, white_list, black_list, limit_list):
+        self.white_list = MappingProxyType(copy.deepcopy(dict(white_list)))
+        self.black_list = MappingProxyType(copy.deepcopy(dict(black_list)))
+        self.limit_list = MappingProxyType(dict(limit_list))
+        # identifies the filter configuration results were computed with
+        self.fingerprint = generic.get_checksum(json.dumps([dict(self.white_list), dict(self.black_list),
+                                                            dict(self.limit_list)], sort_keys=True, default=str))
+
+    def to_dict(self):
+        filter_dictionary = {'whitelist': copy.deepcopy(dict(self.white_list)),
+                             'blacklist': copy.deepcopy(dict(self.black_list))}
+        if self.limit_list:
+            filter_dictionary['limits'] = dict(self.limit_list)
+        return filter_dictionary
+
+
+config = FilterConfig(DEFAULT_WHITE_LIST, {}, {})
+# serializes read-modify-write of the configuration
+config_lock = threading.RLock()
+pinned = threading.local()
+
+
+def get_config():
+    """The configuration pinned to this thread by use_config(), the current one otherwise."""
+    return getattr(pinned, 'config', None) or config
+
+
+def set_config(white_list=None, black_list=None, limit_list=None):
+    """Replaces the given parts of the configuration, the others are kept."""
+    global config
+    with config_lock:
+        config = FilterConfig(config.white_list if white_list is None else white_list,
+                              config.black_list if black_list is None else black_list,
+                              config.limit_list if limit_list is None else limit_list)
+        return config
+
+
+@contextmanager
+def use_config(filter_config=None):
+    """Pins a configuration (by default the current one) to this thread, e.g. for all stations of a download."""
+    previous = getattr(pinned, 'config', None)
+    pinned.config = filter_config or get_config()
+    try:
+        yield pinned.config
+    finally:
+        pinned.config = previous
+
+
 def init_filter_file():
-    global white_list, black_list, limit_list
     logging.info('Reading Limits and Filters')
     filter_dictionary = generic.read_yaml_file(generic.get_filter_file())
     if filter_dictionary is None:
         filter_dictionary = {}
-        is_updated = True
-    if 'whitelist' in filter_dictionary:
-        if filter_dictionary['whitelist'] is None:
-            white_list = { "lastcheckok" : 1}
-        else:
-            # Copy so the default is preserved.
-            for f in filter_dictionary['whitelist']:
-                white_list[f]=filter_dictionary['whitelist'][f]
-
-    if 'blacklist' in filter_dictionary:
-        # reference, no defaults
-        if filter_dictionary['blacklist'] is None:
-            black_list={}
-        else:
-            black_list=filter_dictionary['blacklist']
-
-    if 'limits' in filter_dictionary:
-        set_limits(filter_dictionary['limits'])
+    # built from scratch, items removed from the file are gone after a reload
+    white_list = dict(DEFAULT_WHITE_LIST)
+    if filter_dictionary.get('whitelist'):
+        white_list.update(filter_dictionary['whitelist'])
+    black_list = filter_dictionary.get('blacklist') or {}
+    limit_list = get_valid_limits({}, filter_dictionary.get('limits') or {})
+    return set_config(white_list, black_list, limit_list)
 
 def write_filter_config():
-    global limit_list
-    filter_dictionary = {'whitelist': white_list, 'blacklist': black_list}
-    if len(limit_list) > 0: filter_dictionary['limits']=limit_list
-    generic.write_yaml_file(generic.get_var_path() + '/filter.yml', filter_dictionary)
+    generic.write_yaml_file(generic.get_var_path() + '/filter.yml', get_config().to_dict())
+
+def get_filter_fingerprint():
+    return get_config().fingerprint
+
+def update_filter(list_name, items):
+    """Adds or updates items of the 'white_list' or 'black_list', items with a None value are removed."""
+    with config_lock:
+        filter_list = copy.deepcopy(dict(getattr(config, list_name)))
+        for name in items:
+            if items[name] is None:
+                filter_list.pop(name, None)
+            else:
+                filter_list[name] = items[name]
+        filter_config = set_config(**{list_name: filter_list})
+    return dict(getattr(filter_config, list_name))
 
 def begin_filter():
     global parameter_failed_list
@@ -71,6 +133,7 @@ def parameter_failed_evt(param_name):
     if old:
         count = old + 1
     parameter_failed_list[param_name] = count
+    metrics.filter_rejections.inc(parameter=param_name)
 
 
 def verify_value(ref_val, val):
@@ -96,6 +159,9 @@ def verify_value(ref_val, val):
 
 
 def chk_parameter(parameter_name, val):
+    filter_config = get_config()
+    black_list = filter_config.black_list
+    white_list = filter_config.white_list
     if black_list:
         if parameter_name in black_list:
             if verify_value(black_list[parameter_name], val):
@@ -110,6 +176,10 @@ def check_station(station_json):
     global count_used
     global count_hit
     count_used = count_used + 1
+    metrics.filter_checks.inc()
+    filter_config = get_config()
+    black_list = filter_config.black_list
+    white_list = filter_config.white_list
     station_name = get_json_attr(station_json, 'name')
     if not station_name:
         # müll response
@@ -141,7 +211,7 @@ def check_station(station_json):
 
 
 def get_limit(param_name):
-    global limit_defs
+    limit_list = get_config().limit_list
     if param_name in limit_defs_int: return limit_list.get(param_name,limit_defs_int[param_name])
     if param_name in limit_defs_bool: return limit_list.get(param_name,limit_defs_bool[param_name])
     else: return None
@@ -151,20 +221,27 @@ def get_limit_list():
     my_limits={}
     limit_defs=dict(limit_defs_int)
     limit_defs.update(limit_defs_bool)
-    for l in limit_defs:
-         my_limits[l]=get_limit(l)
+    # one configuration for all limits
+    with use_config():
+        for l in limit_defs:
+             my_limits[l]=get_limit(l)
     return my_limits
 
 def set_limits(limits):
-    global limit_list, limit_defs_int, limit_defs_bool
+    with config_lock:
+        set_config(limit_list=get_valid_limits(config.limit_list, limits))
+    return get_limit_list()
+
+def get_valid_limits(limit_list, limits):
+    limit_list = dict(limit_list)
     for l in limits:
         if limits[l] == None:
             limit_list.pop(l, None)
         elif l in limit_defs_int:
-            if isinstance(limits[l], int) and limits[l] > 0:
+            if isinstance(limits[l], int) and not isinstance(limits[l], bool) and (limits[l] > 0 or limits[l] == 0 and l in limit_defs_zero):
                 limit_list[l]=limits[l]
         elif l in limit_defs_bool:
             if isinstance(limits[l], bool): limit_list[l]=limits[l]
         else:
-            loggin.error("Invalid limit %s") % l
-    return get_limit_list()
+            logging.error("Invalid limit %s", l)
+    return limit_list
@@ -1,13 +1,20 @@
-from ycast import generic, my_stations
+import threading
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
+from ycast import generic, my_stations, metrics, sqlite_storage, my_devices, my_filter
 from ycast.generic import get_recently_file
 
 MAX_ENTRIES = 15
-# define a max, so after 5 hits, another station is get better votes
-MAX_VOTES = 5
+MAX_VOTED = 5
 DIRECTORY_NAME = "recently used"
+# internal scores are rescaled once the weight of a new hit exceeds this
+RENORMALIZE_WEIGHT = 1e6
 
 recently_station_dictionary = None
-voted5_station_dictinary = None
+recently_ranking = None
+# serializes the read-modify-write of concurrent station selections
+recently_lock = threading.Lock()
 
 
 class StationVote:
@@ -20,43 +27,144 @@ class StationVote:
         if len(params) > 1:
             self.icon = params[1]
             if len(params) > 2:
-                self.vote = int(params[2])
+                self.vote = float(params[2])
 
     def to_params_txt(self):
-        text_line = self.url + '|' + self.icon + '|' + str(self.vote)
+        text_line = self.url + '|' + self.icon + '|' + '%g' % round(self.vote, 2)
         return text_line
 
     def to_server_station(self, cathegory):
         return my_stations.Station(self.name, self.url, cathegory, self.icon)
 
 
-def signal_station_selected(name, url, icon):
-    recently_station_list = get_stations_list()
-    station_hit = StationVote(name, url + '|' + icon)
-    for recently_station in recently_station_list:
-        if name == recently_station.name:
-            station_hit.vote = recently_station.vote + 1
-            recently_station_list.remove(recently_station)
+class Ranking:
+    """
+    Recently selected stations in selection order and ranked by a decaying vote: every selection adds 1 to the
+    vote of the station, older selections lose half of their weight after VOTE_HALF_LIFE selections.
+    Instead of decaying all votes, the weight of a new selection grows, so a selection costs O(log n).
+    """
+
+    def __init__(self, dictionary, station_list):
+        self.dictionary = dictionary
+        self.weight = 1.0
+        # name -> [score, StationVote], most recent last
+        self.stations = OrderedDict()
+        # (-score, name), best first
+        self.ranked = []
+        for station in reversed(station_list):
+            self.stations[station.name] = [station.vote, station]
+            insort(self.ranked, (-station.vote, station.name))
+
+    def select(self, station, half_life):
+        self.weight *= 2 ** (1 / max(half_life, 1))
+        entry = self.stations.pop(station.name, None)
+        score = self.weight
+        if entry:
+            self.remove_ranked(entry[0], station.name)
+            score += entry[0]
+        self.stations[station.name] = [score, station]
+        insort(self.ranked, (-score, station.name))
+        if len(self.stations) > MAX_ENTRIES:
+            # remove oldest entry
+            name, (oldest_score, _) = self.stations.popitem(last=False)
+            self.remove_ranked(oldest_score, name)
+        if self.weight > RENORMALIZE_WEIGHT:
+            self.renormalize()
+
+    def remove_ranked(self, score, name):
+        del self.ranked[bisect_left(self.ranked, (-score, name))]
+
+    def renormalize(self):
+        for entry in self.stations.values():
+            entry[0] /= self.weight
+        self.ranked = sorted((-score, name) for name, (score, _) in self.stations.items())
+        self.weight = 1.0
+
+    def get_station(self, name):
+        score, station = self.stations[name]
+        station.vote = score / self.weight
+        return station
+
+    def get_recently(self):
+        return [self.get_station(name) for name in reversed(self.stations)]
+
+    def get_voted(self, count):
+        return [self.get_station(name) for _, name in self.ranked[:count]]
+
+
+def get_ranking(mac=None):
+    global recently_ranking
+    dictionary = get_recently_stations_dictionary(mac)
+    holder = my_devices.get_device(mac) if mac else None
+    ranking = holder.ranking if holder else recently_ranking
+    if ranking is None or ranking.dictionary is not dictionary:
+        ranking = Ranking(dictionary, get_stations_list(mac))
+        if holder:
+            holder.ranking = ranking
+        else:
+            recently_ranking = ranking
+    return ranking
+
+
+def signal_station_selected(name, url, icon, mac=None):
+    with recently_lock:
+        update_station_selected(name, url, icon)
+        if mac:
+            update_station_selected(name, url, icon, mac)
+
+
+def update_station_selected(name, url, icon, mac=None):
+    ranking = get_ranking(mac)
+    ranking.select(StationVote(name, url + '|' + (icon or '')), my_filter.get_limit('VOTE_HALF_LIFE'))
+    ranking.dictionary = mk_station_dictionary(directory_name(mac), ranking.get_recently())
+    set_recently_station_dictionary(ranking.dictionary, mac)
+
+
+def set_recently_station_dictionary(station_dict, mac=None):
+    global recently_station_dictionary
+    if mac:
+        # saved later by my_devices.flush()
+        my_devices.get_device(mac).set_recently(station_dict)
+        return
+    recently_station_dictionary = station_dict
+    with metrics.recently_write_duration.time():
+        if sqlite_storage.is_enabled():
+            sqlite_storage.put_recently(*get_recently_rows(station_dict))
+        else:
+            # don't block the icon request, a concurrent writer writes the latest state
+            generic.write_yaml_file(get_recently_file(), recently_station_dictionary, wait=False)
+
+
+def get_recently_rows(station_dict):
+    rows = []
+    name = DIRECTORY_NAME
+    if station_dict:
+        for name in station_dict:
+            for station_key in station_dict[name]:
+                station = StationVote(station_key, station_dict[name][station_key])
+                rows.append((station.name, station.url, station.icon, station.vote))
             break
+    return name, rows
 
-    recently_station_list.insert(0, station_hit)
 
-    if station_hit.vote > MAX_VOTES:
-        for recently_station in recently_station_list:
-            if recently_station.vote > 0:
-                recently_station.vote = recently_station.vote - 1
+def get_database_dictionary():
+    rows = sqlite_storage.get_recently()
+    if not rows:
+        return None
+    station_dictionary = {}
+    for name, url, icon, vote in rows:
+        station_dictionary[name] = url + '|' + (icon or '') + '|' + str(vote)
+    return {sqlite_storage.get_recently_directory_name() or DIRECTORY_NAME: station_dictionary}
 
-    if len(recently_station_list) > MAX_ENTRIES:
-        # remove last (oldest) entry
-        recently_station_list.pop()
 
-    set_recently_station_dictionary(mk_station_dictionary(directory_name(), recently_station_list))
+def import_yaml_file(file_name):
+    global recently_station_dictionary
+    sqlite_storage.put_recently(*get_recently_rows(generic.read_yaml_file(file_name)))
+    recently_station_dictionary = None
 
 
-def set_recently_station_dictionary(station_dict):
-    global recently_station_dictionary
-    recently_station_dictionary = station_dict
-    generic.write_yaml_file(get_recently_file(), recently_station_dictionary)
+def export_yaml_file(file_name):
+    generic.write_yaml_file(file_name, get_database_dictionary() or {})
 
 
 def mk_station_dictionary(cathegory, station_list):
@@ -69,9 +177,9 @@ def mk_station_dictionary(cathegory, station_list):
     return new_cathegory_dictionary
 
 
-def get_stations_list():
+def get_stations_list(mac=None):
     stations_list = []
-    cathegory_dict = get_recently_stations_dictionary()
+    cathegory_dict = get_recently_stations_dictionary(mac)
     if cathegory_dict:
         for cat_key in cathegory_dict:
             station_dict = cathegory_dict[cat_key]
@@ -80,35 +188,42 @@ def get_stations_list():
     return stations_list
 
 
-def get_recently_stations_dictionary():
+def get_recently_stations_dictionary(mac=None):
+    # a device starts without history, the shared one holds the selections of all receivers
+    if mac:
+        return my_devices.get_device(mac).recently
     # cached recently
     global recently_station_dictionary
     if not recently_station_dictionary:
-        recently_station_dictionary = generic.read_yaml_file(get_recently_file())
+        if sqlite_storage.is_enabled():
+            recently_station_dictionary = get_database_dictionary()
+        else:
+            recently_station_dictionary = generic.read_yaml_file(get_recently_file())
     return recently_station_dictionary
 
 
-def directory_name():
-    station_dictionary = get_recently_stations_dictionary()
+def directory_name(mac=None):
+    station_dictionary = get_recently_stations_dictionary(mac)
     if station_dictionary:
-        return list(get_recently_stations_dictionary().keys())[0]
+        return list(station_dictionary.keys())[0]
     return DIRECTORY_NAME
 
 
 # used in landing page
-def get_stations_by_vote():
-    station_list = get_stations_list()
-    station_list.sort(key=lambda station: station.vote, reverse=True)
-    station_list = station_list[:5]
+def get_stations_by_vote(mac=None):
+    with recently_lock:
+        station_list = get_ranking(mac).get_voted(MAX_VOTED)
     stations = []
     for item in station_list:
         stations.append(item.to_server_station('voted'))
     return stations
 
 
-def get_stations_by_recently():
-    station_list = get_stations_list()
+def get_stations_by_recently(mac=None):
+    with recently_lock:
+        station_list = get_ranking(mac).get_recently()
+    category = directory_name(mac)
     stations = []
     for item in station_list:
-        stations.append(item.to_server_station(directory_name()))
+        stations.append(item.to_server_station(category))
     return stations
@@ -1,35 +1,75 @@
 import logging
+import threading
 
-import ycast.vtuner as vtuner
 import ycast.generic as generic
+from ycast import sqlite_storage, my_devices, stream_resolver
 
 ID_PREFIX = "MY"
 
 
-class Station:
+class Station(generic.Station):
+    __slots__ = ()
+
     def __init__(self, name, url, category, icon):
-        self.id = generic.generate_stationid_with_prefix(
-            generic.get_checksum(name + url), ID_PREFIX)
-        self.name = name
-        self.url = url
-        self.tag = category
-        self.icon = icon
-
-    def to_vtuner(self):
-        return vtuner.Station(self.id, self.name, self.tag, self.url, self.icon, self.tag, None, None, None, None)
-
-    def to_dict(self):
-        return {'name': self.name , 'url': self.url, 'icon': self.icon, 'description': self.tag }
-
-
-def get_station_by_id(vtune_id):
-    my_stations_yaml = get_stations_yaml()
-    if my_stations_yaml:
-        for category in my_stations_yaml:
-            for station in get_stations_by_category(category):
-                if vtune_id == station.id:
+        super().__init__(get_station_id(name, url), name, url, icon, description=category, genre=category)
+
+
+stations_index = None
+# serializes read-modify-write of the bookmarks
+bookmarks_lock = threading.Lock()
+
+
+class StationsIndex:
+    def __init__(self, stations_yaml, stations_file_signature, recently_dictionary):
+        self.stations_file_signature = stations_file_signature
+        self.recently_dictionary = recently_dictionary
+        self.categories = {}
+        self.stations_by_id = {}
+        if stations_yaml:
+            for category in stations_yaml:
+                stations = get_stations_from_yaml(category, stations_yaml[category])
+                self.categories[category] = stations
+                for station in stations:
+                    self.stations_by_id.setdefault(station.id, station)
+
+    def is_current(self, stations_file_signature, recently_dictionary):
+        return self.stations_file_signature == stations_file_signature and \
+            self.recently_dictionary is recently_dictionary
+
+
+def get_stations_index():
+    global stations_index
+    from ycast.my_recentlystation import get_recently_stations_dictionary
+    recently_dictionary = get_recently_stations_dictionary()
+    stations_file_signature = generic.get_file_signature(generic.get_stations_file())
+    index = stations_index
+    if index is None or not index.is_current(stations_file_signature, recently_dictionary):
+        index = StationsIndex(get_stations_yaml(), stations_file_signature, recently_dictionary)
+        stations_index = index
+    return index
+
+
+def get_station_by_id(vtune_id, mac=None):
+    if mac:
+        for stations in get_device_categories(mac).values():
+            for station in stations:
+                if station.id == vtune_id:
                     return station
-    return None
+    if sqlite_storage.is_enabled():
+        row = sqlite_storage.get_bookmark_by_station_id(vtune_id)
+        if row:
+            category, name, url, icon = row
+            return Station(name, url, category, icon)
+        for station in get_recently_stations():
+            if station.id == vtune_id:
+                return station
+        return None
+    return get_stations_index().stations_by_id.get(vtune_id)
+
+
+def get_recently_stations():
+    from ycast.my_recentlystation import get_stations_by_recently
+    return get_stations_by_recently()
 
 
 def get_stations_yaml():
@@ -44,21 +84,65 @@ def get_stations_yaml():
     return my_stations
 
 
-def get_category_directories():
-    my_stations_yaml = get_stations_yaml()
+def get_device_categories(mac):
+    """Stations of the bookmark overlay and recently played stations of a device by category."""
+    device = my_devices.get_device(mac)
+    categories = device.get_categories()
+    device_stations = device.stations
+    if device_stations is None or device_stations[0] is not categories:
+        device_stations = (categories, {category: get_stations_from_yaml(category, categories[category])
+                                        for category in categories})
+        device.stations = device_stations
+    return device_stations[1]
+
+
+def get_category_directories(mac=None):
+    if mac:
+        device_categories = get_device_categories(mac)
+        categories = [directory for directory in get_category_directories()
+                      if directory.name not in device_categories]
+        for category, stations in device_categories.items():
+            categories.append(generic.Directory(category, len(stations)))
+        return categories
     categories = []
-    if my_stations_yaml:
-        for category in my_stations_yaml:
-            categories.append(generic.Directory(category, len(get_stations_by_category(category))))
+    if sqlite_storage.is_enabled():
+        from ycast.my_recentlystation import directory_name
+        recently_stations = get_recently_stations()
+        recently_category = directory_name() if recently_stations else None
+        for category, count in sqlite_storage.get_categories():
+            if category != recently_category:
+                categories.append(generic.Directory(category, count))
+        if recently_category:
+            categories.append(generic.Directory(recently_category, len(recently_stations)))
+        return categories
+    for category, stations in get_stations_index().categories.items():
+        categories.append(generic.Directory(category, len(stations)))
     return categories
 
 
-def get_stations_by_category(category):
-    my_stations_yaml = get_stations_yaml()
+def get_stations_by_category(category, mac=None):
+    if mac:
+        device_categories = get_device_categories(mac)
+        if category in device_categories:
+            return list(device_categories[category])
+    if sqlite_storage.is_enabled():
+        from ycast.my_recentlystation import directory_name
+        recently_stations = get_recently_stations()
+        if recently_stations and category == directory_name():
+            return recently_stations
+        return get_stations_from_rows(sqlite_storage.get_bookmarks(category))
+    return list(get_stations_index().categories.get(category, []))
+
+
+def get_stations_from_rows(rows):
+    return [Station(name, url, category, icon) for category, name, url, icon in rows]
+
+
+def get_stations_from_yaml(category, category_yaml):
     stations = []
-    if my_stations_yaml and category in my_stations_yaml:
-        for station_name in my_stations_yaml[category]:
-            station_urls = my_stations_yaml[category][station_name]
+    if category_yaml:
+        for station_name in category_yaml:
+            station_urls = category_yaml[station_name]
             param_list = station_urls.split('|')
             station_url = param_list[0]
             station_icon = None
@@ -67,22 +151,106 @@ def get_stations_by_category(category):
             stations.append(Station(station_name, station_url, category, station_icon))
     return stations
 
+
 def get_all_bookmarks_stations():
+    if sqlite_storage.is_enabled():
+        return get_stations_from_rows(sqlite_storage.get_bookmarks())
     bm_stations_category = generic.read_yaml_file(generic.get_stations_file())
     stations = []
     if bm_stations_category :
         for category in bm_stations_category:
-            for station_name in bm_stations_category[category]:
-                station_urls = bm_stations_category[category][station_name]
-                param_list = station_urls.split('|')
-                station_url = param_list[0]
-                station_icon = None
-                if len(param_list) > 1:
-                    station_icon = param_list[1]
-                stations.append(Station(station_name, station_url, category, station_icon))
+            stations.extend(get_stations_from_yaml(category, bm_stations_category[category]))
     return stations
 
 
+def warm_up():
+    if sqlite_storage.is_enabled():
+        logging.info("My Stations stored in SQLite (%d categories)", len(sqlite_storage.get_categories()))
+    else:
+        index = get_stations_index()
+        logging.info("My Stations index loaded (%d categories, %d stations)",
+                     len(index.categories), len(index.stations_by_id))
+    # expand playlists and check the bookmarked streams before they are played
+    for station in get_all_bookmarks_stations():
+        stream_resolver.resolve_later(station.url)
+
+
+def get_station_id(name, url):
+    return generic.generate_stationid_with_prefix(generic.get_checksum(name + url), ID_PREFIX)
+
+
+def get_bookmarks_version():
+    if sqlite_storage.is_enabled():
+        return sqlite_storage.get_bookmarks_version()
+    return generic.get_checksum(str(generic.get_file_signature(generic.get_stations_file())))
+
+
+def patch_bookmarks(operations, version=None):
+    """
+    Applies a list of bookmark operations:
+        {"op": "add", "category": ..., "name": ..., "url": ..., "icon": ...}
+        {"op": "remove", "category": ..., "name": ...}
+        {"op": "move", "category": ..., "name": ..., "to": <category>, "position": <index, default last>}
+        {"op": "rename", "category": ..., "name": ..., "to": <name>}
+        {"op": "rename_category", "category": ..., "to": <category>}
+    Returns the new version of the bookmarks or None if they are not at the expected version anymore.
+    Raises ValueError for invalid operations, nothing is changed in that case.
+    """
+    if not isinstance(operations, list):
+        raise ValueError("List of operations expected")
+    try:
+        if sqlite_storage.is_enabled():
+            return sqlite_storage.patch_bookmarks(operations, version, get_station_id)
+        with bookmarks_lock:
+            if version is not None and version != get_bookmarks_version():
+                return None
+            stations_yaml = generic.read_yaml_file(generic.get_stations_file()) or {}
+            for operation in operations:
+                stations_yaml = apply_operation(stations_yaml, operation)
+            generic.write_yaml_file(generic.get_stations_file(), stations_yaml)
+            return get_bookmarks_version()
+    except (KeyError, TypeError, AttributeError) as e:
+        raise ValueError("Invalid operation: %s" % e)
+
+
+def apply_operation(stations_yaml, operation):
+    op = operation['op']
+    category = operation['category']
+    if op == 'add':
+        station = operation['url'] + '|' + operation['icon'] if operation.get('icon') else operation['url']
+        stations_yaml[category] = stations_yaml.get(category) or {}
+        stations_yaml[category].pop(operation['name'], None)
+        stations_yaml[category][operation['name']] = station
+        return stations_yaml
+    if category not in stations_yaml:
+        raise ValueError("Category '%s' not found" % category)
+    if op == 'rename_category':
+        if operation['to'] in stations_yaml:
+            raise ValueError("Category '%s' exists" % operation['to'])
+        return {operation['to'] if key == category else key: value for key, value in stations_yaml.items()}
+    stations = stations_yaml[category] or {}
+    name = operation['name']
+    if name not in stations:
+        raise ValueError("Bookmark '%s' not found in '%s'" % (name, category))
+    if op == 'remove':
+        del stations[name]
+    elif op == 'rename':
+        stations_yaml[category] = {operation['to'] if key == name else key: value
+                                   for key, value in stations.items() if key != operation['to'] or key == name}
+    elif op == 'move':
+        station = stations.pop(name)
+        target = operation.get('to', category)
+        target_stations = [(key, value) for key, value in (stations_yaml.get(target) or {}).items() if key != name]
+        position = operation.get('position')
+        target_stations.insert(len(target_stations) if position is None else position, (name, station))
+        stations_yaml[target] = dict(target_stations)
+    else:
+        raise ValueError("Unknown operation '%s'" % op)
+    if not stations_yaml[category]:
+        del stations_yaml[category]
+    return stations_yaml
+
+
 def putBookmarkJson(elements):
     newDict={}
     for stationJson in elements:
@@ -95,5 +263,30 @@ def putBookmarkJson(elements):
         else:
             newDict[stationJson['description']][stationJson['name']] = stationJson['url']
 
-    generic.write_yaml_file(generic.get_stations_file(),newDict)
+    # not interleaved with a PATCH of the same file
+    with bookmarks_lock:
+        if sqlite_storage.is_enabled():
+            sqlite_storage.put_bookmarks(get_bookmark_rows(newDict))
+        else:
+            generic.write_yaml_file(generic.get_stations_file(),newDict)
     return elements
+
+
+def get_bookmark_rows(stations_yaml):
+    rows = []
+    if stations_yaml:
+        for category in stations_yaml:
+            for station in get_stations_from_yaml(category, stations_yaml[category]):
+                rows.append((category, station.name, station.url, station.icon, station.id))
+    return rows
+
+
+def import_yaml_file(file_name):
+    sqlite_storage.put_bookmarks(get_bookmark_rows(generic.read_yaml_file(file_name)))
+
+
+def export_yaml_file(file_name):
+    stations_yaml = {}
+    for category, name, url, icon in sqlite_storage.get_bookmarks():
+        stations_yaml.setdefault(category, {})[name] = url + '|' + icon if icon else url
+    generic.write_yaml_file(file_name, stations_yaml)
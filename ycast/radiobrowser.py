@@ -1,93 +1,295 @@
 import base64
+import codecs
 import json
-import uuid
-
-import requests
 import logging
+import os
+import pickle
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-from ycast import __version__, my_filter
-import ycast.vtuner as vtuner
+from ycast import __version__, my_filter, metrics, tracing, limiter
 import ycast.generic as generic
 from ycast.my_filter import check_station, begin_filter, end_filter, get_limit 
 from ycast.generic import get_json_attr
 
 API_ENDPOINT = "http://all.api.radio-browser.info"
+TIMEOUT = (5, 30)
 ID_PREFIX = "RB"
+STREAM_CHUNK_SIZE = 64 * 1024
+STATION_CACHE_SIZE = 20000
+CLICK_WORKERS = 2
+# words dropped from the end of tags when merging them with an existing tag, e.g. 'rock music' -> 'rock'
+GENERIC_TAG_WORDS = ('music', 'musik', 'musica', 'radio')
+# upstream tags queried for the stations of a merged genre, the most used first
+MAX_MERGED_TAGS = 5
+# directory indexes are served from memory and refreshed in the background once expired
+INDEX_KINDS = ('country_index', 'language_index', 'genre_index')
+# cached results kept as last known good ones, also after they expired, see also the CACHE_STATIONS limit
+RESPONSE_CACHE_SIZE = 1000
+# seconds between the cache snapshots written while running
+SNAPSHOT_INTERVAL = 600
+
+# requests and the optional orjson are imported on first use to keep the startup fast
+json_loads = None
+SNAPSHOT_FILE = 'radiobrowser.pickle'
+
+# station id -> Station, the least recently listed first
+station_cache = OrderedDict()
+# (kind, apicall, filter fingerprint) -> (timestamp, filtered result), the least recently fetched first
+response_cache = OrderedDict()
+# held for every change of response_cache and every iteration over it
+cache_lock = threading.Lock()
+upstream_flight = metrics.register_single_flight(generic.SingleFlight('Radiobrowser'))
+breaker = generic.CircuitBreaker('Radiobrowser API')
+# per request thread: set if a result could not be fetched and was served from the cache
+request_state = threading.local()
+snapshot_saved = time.time()
+snapshot_lock = threading.Lock()
+# station uuid -> (timestamp, playable url), filled by the asynchronous click reports
+playable_urls = OrderedDict()
+# held for every change of station_cache and playable_urls
+stations_lock = threading.Lock()
+pending_clicks = set()
+click_lock = threading.Lock()
+click_executor = None
+refreshing = set()
+refreshing_lock = threading.Lock()
+
+
+class Unavailable(Exception):
+    pass
 
-station_cache = {}
 
+class Station(generic.Station):
+    __slots__ = ()
 
-class Station:
     def __init__(self, station_json):
-        self.stationuuid = generic.get_json_attr(station_json, 'stationuuid')
-        self.id = generic.generate_stationid_with_prefix(
-            base64.urlsafe_b64encode(uuid.UUID(self.stationuuid).bytes).decode(), ID_PREFIX)
-        self.name = generic.get_json_attr(station_json, 'name')
-
-        self.url = generic.get_json_attr(station_json, 'url_resolved')
-        if not self.url:
-            self.url = generic.get_json_attr(station_json, 'url')
-
-        self.icon = generic.get_json_attr(station_json, 'favicon')
-        self.description = generic.get_json_attr(station_json, 'tags')
-        self.tags = generic.get_json_attr(station_json, 'tags').split(',')
-        self.countrycode = generic.get_json_attr(station_json, 'countrycode')
-        self.language = generic.get_json_attr(station_json, 'language')
-        self.languagecodes = generic.get_json_attr(station_json, 'languagecodes')
-        self.votes = generic.get_json_attr(station_json, 'votes')
-        self.codec = generic.get_json_attr(station_json, 'codec')
-        self.bitrate = generic.get_json_attr(station_json, 'bitrate')
-
-    def to_vtuner(self):
-        return vtuner.Station(self.id, self.name,
-                              self.description, self.url, self.icon,
-                              self.tags[0], self.countrycode, self.codec, self.bitrate, None)
-    def to_dict(self):
-        return {'name': self.name , 'url': self.url, 'icon': self.icon, 'description': self.description }
+        stationuuid = station_json.get('stationuuid')
+        super().__init__(generic.generate_stationid_with_prefix(
+                             base64.urlsafe_b64encode(uuid.UUID(stationuuid).bytes).decode(), ID_PREFIX),
+                         station_json.get('name'),
+                         station_json.get('url_resolved') or station_json.get('url'),
+                         icon=station_json.get('favicon'),
+                         description=station_json.get('tags'),
+                         countrycode=station_json.get('countrycode'),
+                         language=station_json.get('language'),
+                         languagecodes=station_json.get('languagecodes'),
+                         codec=station_json.get('codec'),
+                         bitrate=station_json.get('bitrate'),
+                         votes=station_json.get('votes'),
+                         uuid=stationuuid)
 
     def get_playable_url(self):
-        try:
-            playable_url_json = request('url/' + str(self.stationuuid))
-            self.url = playable_url_json['url']
+        """
+        Returns the station with the last resolved playable URL (or the one from the station list) without
+        waiting for Radiobrowser; the click is reported and the URL resolved again in the background.
+        """
+        report_click(self.uuid)
+        with stations_lock:
+            entry = playable_urls.get(self.uuid)
+        if entry and time.time() - entry[0] < get_limit('CACHE_TTL'):
+            return self.replace(url=entry[1])
+        return self
+
+
+def report_click(station_uuid):
+    global click_executor
+    with click_lock:
+        if station_uuid in pending_clicks:
+            return
+        pending_clicks.add(station_uuid)
+        if click_executor is None:
+            click_executor = ThreadPoolExecutor(max_workers=CLICK_WORKERS, thread_name_prefix='radiobrowser-click')
+    click_executor.submit(resolve_playable_url, station_uuid)
+
+
+def resolve_playable_url(station_uuid):
+    # the url/<uuid> request also counts the click
+    try:
+        playable_url_json = request('url/' + str(station_uuid))
+        with stations_lock:
+            remember(playable_urls, station_uuid, (time.time(), playable_url_json['url']))
+    except (IndexError, KeyError, TypeError):
+        logging.error("Could not retrieve first playlist item for station with uuid '%s'", station_uuid)
+    except Exception as ex:
+        logging.error("Could not report click for station with uuid '%s': %s", station_uuid, ex)
+    finally:
+        with click_lock:
+            pending_clicks.discard(station_uuid)
+
 
-        except (IndexError, KeyError):
-            logging.error("Could not retrieve first playlist item for station with id '%s'", self.stationuuid)
+def remember(cache, key, value):
+    # called with stations_lock held, the oldest entries are dropped beyond STATION_CACHE_SIZE
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > STATION_CACHE_SIZE:
+        cache.popitem(last=False)
 
 
 def request(url):
+    with tracing.span('radiobrowser.request'):
+        return upstream_flight.do(('json', url), fetch_json, url)
+
+
+def fetch_json(url):
     logging.debug("Radiobrowser API request: %s", url)
+    with limiter.upstream.limit():
+        response = get_response(url)
+        if response is None:
+            return {}
+        content = response.content
+    return decode_json(content)
+
+
+def request_stream(url):
+    """
+    Yields the elements of a JSON array response one by one while it is downloaded, so large station lists
+    never have to be held in memory as a whole. The download counts against UPSTREAM_CONCURRENCY until the
+    response is consumed and closed.
+    """
+    import requests
+    logging.debug("Radiobrowser API stream request: %s", url)
+    with limiter.upstream.limit():
+        response = get_response(url, stream=True)
+        if response is None:
+            return
+        try:
+            yield from iter_json_array(response.iter_content(chunk_size=STREAM_CHUNK_SIZE))
+        except requests.exceptions.RequestException as err:
+            logging.error("Connection to Radiobrowser API interrupted (%s)", err)
+            raise get_unavailable(url, err) from err
+        except ValueError as err:
+            logging.error("Invalid JSON from Radiobrowser API (%s)", err)
+            raise get_unavailable(url, err) from err
+        finally:
+            response.close()
+
+
+def get_response(url, stream=False):
+    """
+    Response of an API call, None if Radiobrowser rejected the call. Raises Unavailable if Radiobrowser
+    could not be reached, failed or is not called for now after repeated failures (see CircuitBreaker).
+    Called with a slot of limiter.upstream held until the response is read.
+    """
+    import requests
     headers = {'content-type': 'application/json', 'User-Agent': generic.USER_AGENT + '/' + __version__}
+    if not breaker.allow():
+        raise Unavailable("Radiobrowser API not called after %d failures" % breaker.failures)
     try:
-        response = requests.get(API_ENDPOINT + '/json/' + url, headers=headers)
-    except requests.exceptions.ConnectionError as err:
+        # only the round trip, streamed responses until their headers arrived
+        with metrics.upstream_request_duration.time(endpoint=get_endpoint(url)):
+            response = requests.get(API_ENDPOINT + '/json/' + url, headers=headers, stream=stream, timeout=TIMEOUT)
+    except requests.exceptions.RequestException as err:
         logging.error("Connection to Radiobrowser API failed (%s)", err)
-        return {}
+        raise get_unavailable(url, err) from err
     if response.status_code != 200:
         logging.error("Could not fetch data from Radiobrowser API (HTML status %s)", response.status_code)
-        return {}
-    return response.json()
+        response.close()
+        if response.status_code >= 500 or response.status_code == 429:
+            raise get_unavailable(url, 'HTML status %s' % response.status_code)
+        metrics.upstream_errors.inc(endpoint=get_endpoint(url))
+        breaker.succeeded()
+        return None
+    breaker.succeeded()
+    return response
+
+
+def get_unavailable(url, error):
+    metrics.upstream_errors.inc(endpoint=get_endpoint(url))
+    breaker.failed(error)
+    return Unavailable(str(error))
+
+
+def get_endpoint(url):
+    endpoint = url.split('?', 1)[0]
+    if endpoint.startswith('url/'):
+        # drop the station uuid
+        return 'url'
+    return endpoint
+
+
+def decode_json(data):
+    global json_loads
+    if json_loads is None:
+        try:
+            import orjson
+            json_loads = orjson.loads
+        except ImportError:
+            json_loads = json.loads
+    return json_loads(data)
+
+
+def iter_json_array(chunks):
+    decoder = json.JSONDecoder()
+    utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    pos = 0
+    started = False
+    for chunk in chunks:
+        buffer = buffer[pos:] + utf8_decoder.decode(chunk)
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= len(buffer):
+                break
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError("JSON array expected")
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == ']':
+                return
+            try:
+                element, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # element is not complete yet, wait for the next chunk
+                break
+            yield element
+    if started:
+        raise ValueError("Unexpected end of JSON array")
 
 
 def get_station_by_id(vtune_id):
-    global station_cache
     # decode
     uidbase64 = generic.get_stationid_without_prefix(vtune_id)
     uid = str(uuid.UUID(base64.urlsafe_b64decode(uidbase64).hex()))
-    if station_cache:
-        station = station_cache[vtune_id]
-        if station:
-            return station
+    with stations_lock:
+        station = station_cache.get(vtune_id)
+    if station:
+        return station
     # no item in cache, do request
-    station_json = request('stations/byuuid?uuids=' + uid)
+    try:
+        station_json = request('stations/byuuid?uuids=' + uid)
+    except Unavailable:
+        return None
     if station_json and len(station_json):
         station = Station(station_json[0])
         if station:
-            station_cache[station.id] = station
+            with stations_lock:
+                remember(station_cache, station.id, station)
         return station
     return None
 
 
 def get_country_directories():
+    return get_country_index().directories
+
+
+def get_country_index():
+    return get_cached('country_index', fetch_country_index)
+
+
+def fetch_country_index():
+    return generic.DirectoryIndex(fetch_country_directories())
+
+
+def fetch_country_directories():
     country_directories = []
     apicall = 'countries'
     if not get_limit('SHOW_BROKEN_STATIONS'):
@@ -103,6 +305,18 @@ def get_country_directories():
 
 
 def get_language_directories():
+    return get_language_index().directories
+
+
+def get_language_index():
+    return get_cached('language_index', fetch_language_index)
+
+
+def fetch_language_index():
+    return generic.DirectoryIndex(fetch_language_directories())
+
+
+def fetch_language_directories():
     language_directories = []
     apicall = 'languages'
     if not get_limit('SHOW_BROKEN_STATIONS'):
@@ -119,87 +333,279 @@ def get_language_directories():
 
 
 def get_genre_directories():
-    genre_directories = []
+    return get_genre_index().directories
+
+
+def get_genre_index():
+    return get_cached('genre_index', fetch_genre_index)
+
+
+def fetch_genre_index():
     apicall = 'tags'
     if not get_limit('SHOW_BROKEN_STATIONS'):
         apicall += '?hidebroken=true'
-    genres_raw = request(apicall)
+    return build_genre_index(request(apicall))
+
+
+def build_genre_index(genres_raw):
+    # normalized tag -> {upstream tag: station count}
+    merged = {}
+    known_tags = set()
     for genre_raw in genres_raw:
-        if get_json_attr(genre_raw, 'name') and get_json_attr(genre_raw, 'stationcount') and \
-                int(get_json_attr(genre_raw, 'stationcount')) > get_limit('MINIMUM_COUNT_GENRE'):
-            if my_filter.chk_parameter('tags', get_json_attr(genre_raw, 'name')):
-                genre_directories.append(generic.Directory(get_json_attr(genre_raw, 'name'),
-                                                       get_json_attr(genre_raw, 'stationcount'),
-                                                       get_json_attr(genre_raw, 'name').capitalize()))
-    return genre_directories
+        name = get_json_attr(genre_raw, 'name')
+        if name:
+            known_tags.add(normalize_tag(name))
+    for genre_raw in genres_raw:
+        name = get_json_attr(genre_raw, 'name')
+        station_count = get_json_attr(genre_raw, 'stationcount')
+        if name and station_count and my_filter.chk_parameter('tags', name):
+            genre = normalize_tag(name, known_tags)
+            if genre:
+                merged.setdefault(genre, {})[name] = int(station_count)
+    genre_directories = []
+    names = {}
+    for genre, tags in merged.items():
+        station_count = sum(tags.values())
+        if station_count > get_limit('MINIMUM_COUNT_GENRE'):
+            genre_directories.append(generic.Directory(genre, station_count, genre.capitalize()))
+            names[genre] = sorted(tags, key=tags.get, reverse=True)[:MAX_MERGED_TAGS]
+    return generic.DirectoryIndex(genre_directories, names)
 
 
-def get_stations_by_country(country):
-    begin_filter()
-    station_cache.clear()
-    stations = []
-    stations_list_json = request('stations/search?order=name&reverse=false&countryExact=true&country=' + str(country))
-    for station_json in stations_list_json:
-        if check_station(station_json):
-            cur_station = Station(station_json)
-            station_cache[cur_station.id] = cur_station
-            stations.append(cur_station)
-    end_filter()
+def normalize_tag(tag, tags=()):
+    """
+    Lower case tag with single spaces. A generic last word is dropped if the rest is one of the (normalized)
+    tags, so 'rock music' joins 'rock' while 'public radio' stays a genre of its own.
+    """
+    words = re.split(r'[\s_-]+', tag.strip().lower())
+    words = [word for word in words if word]
+    while len(words) > 1 and words[-1] in GENERIC_TAG_WORDS and ' '.join(words[:-1]) in tags:
+        words.pop()
+    return ' '.join(words)
+
+
+def get_cached(kind, function, *args):
+    # the whole result is computed with the configuration it is cached for, even if it is reloaded meanwhile
+    with my_filter.use_config() as filter_config:
+        key = (kind, args, filter_config.fingerprint)
+        entry = response_cache.get(key)
+        if entry:
+            if time.time() - entry[0] < get_limit('CACHE_TTL'):
+                return entry[1]
+            if kind in INDEX_KINDS:
+                refresh_later(key, function, args, filter_config)
+                if breaker.get_state() != 'closed':
+                    request_state.cached = True
+                return entry[1]
+        try:
+            return fetch_cached(key, function, args)
+        except (limiter.Busy, Unavailable) as ex:
+            if entry:
+                # last known good result
+                logging.info("Radiobrowser not available (%s), serving cached %s", ex, kind)
+                request_state.cached = True
+                return entry[1]
+            raise
+
+
+def is_cached():
+    """True if a result served to the current thread since reset_cached() could not be fetched from Radiobrowser."""
+    return getattr(request_state, 'cached', False)
+
+
+def reset_cached():
+    request_state.cached = False
+
+
+def fetch_cached(key, function, args):
+    # identical concurrent requests share one download, the cached results are never modified
+    result = upstream_flight.do(key, function, *args)
+    if result:
+        with cache_lock:
+            response_cache[key] = (time.time(), result)
+            response_cache.move_to_end(key)
+            evict()
+        save_snapshot_later()
+    return result
+
+
+def evict():
+    # called with cache_lock held, the most recent result is always kept
+    size = sum(len(entry[1]) for entry in response_cache.values())
+    while len(response_cache) > 1 and (len(response_cache) > RESPONSE_CACHE_SIZE or
+                                       size > get_limit('CACHE_STATIONS')):
+        size -= len(response_cache.popitem(last=False)[1][1])
+
+
+def refresh_later(key, function, args, filter_config):
+    with refreshing_lock:
+        if key in refreshing:
+            return
+        refreshing.add(key)
+
+    def refresh():
+        try:
+            with my_filter.use_config(filter_config):
+                fetch_cached(key, function, args)
+        except Exception as ex:
+            logging.error("Could not refresh %s: %s", key[0], ex)
+        finally:
+            with refreshing_lock:
+                refreshing.discard(key)
+    threading.Thread(target=refresh, name='radiobrowser-refresh', daemon=True).start()
+
+
+def invalidate(filter_config):
+    """Drops the results computed with other filter configurations, they are never requested again."""
+    with cache_lock:
+        for key in [key for key in response_cache if key[2] != filter_config.fingerprint]:
+            del response_cache[key]
+
+
+def clear_cache():
+    with cache_lock:
+        response_cache.clear()
+    with stations_lock:
+        station_cache.clear()
+        playable_urls.clear()
+
+
+def get_stations(apicall):
+    stations = get_cached('stations', fetch_stations, apicall)
+    # keep the listed stations for the icon and play requests that follow
+    with stations_lock:
+        for station in stations:
+            remember(station_cache, station.id, station)
     return stations
 
 
-def get_stations_by_language(language):
+def fetch_stations(apicall):
     begin_filter()
-    station_cache.clear()
     stations = []
-    stations_list_json = \
-        request('stations/search?order=name&reverse=false&languageExact=true&language=' + str(language))
-    for station_json in stations_list_json:
-        if check_station(station_json):
-            cur_station = Station(station_json)
-            station_cache[cur_station.id] = cur_station
-            stations.append(cur_station)
-    end_filter()
+    try:
+        # download and filtering are interleaved, one span covers both
+        with tracing.span('radiobrowser.stations'):
+            for station_json in request_stream(apicall):
+                if check_station(station_json):
+                    stations.append(Station(station_json))
+    finally:
+        end_filter()
     return stations
 
 
+def get_stations_by_country(country):
+    return get_stations('stations/search?order=name&reverse=false&countryExact=true&country=' + str(country))
+
+
+def get_stations_by_language(language):
+    return get_stations('stations/search?order=name&reverse=false&languageExact=true&language=' + str(language))
+
+
 def get_stations_by_genre(genre):
-    begin_filter()
-    station_cache.clear()
-    stations = []
-    stations_list_json = request('stations/search?order=name&reverse=false&tagExact=true&tag=' + str(genre))
-    for station_json in stations_list_json:
-        if check_station(station_json):
-            cur_station = Station(station_json)
-            station_cache[cur_station.id] = cur_station
-            stations.append(cur_station)
-    end_filter()
-    return stations
+    with my_filter.use_config():
+        tags = get_genre_index().get_names(genre)
+        if len(tags) == 1:
+            return get_stations('stations/search?order=name&reverse=false&tagExact=true&tag=' + str(tags[0]))
+        # a merged genre lists the stations of all its tags
+        stations = {}
+        for tag in tags:
+            for station in get_stations('stations/search?order=name&reverse=false&tagExact=true&tag=' + str(tag)):
+                stations.setdefault(station.id, station)
+    return sorted(stations.values(), key=lambda station: (station.name or '').lower())
 
 
-def get_stations_by_votes(limit=get_limit('DEFAULT_STATION_LIMIT')):
-    begin_filter()
-    station_cache.clear()
-    stations = []
-    stations_list_json = request('stations?order=votes&reverse=true&limit=' + str(limit))
-    for station_json in stations_list_json:
-        if check_station(station_json):
-            cur_station = Station(station_json)
-            station_cache[cur_station.id] = cur_station
-            stations.append(cur_station)
-    end_filter()
-    return stations
+def get_stations_by_votes(limit=None):
+    if limit is None:
+        limit = get_limit('DEFAULT_STATION_LIMIT')
+    return get_stations('stations?order=votes&reverse=true&limit=' + str(limit))
 
 
-def search(name, limit=get_limit('DEFAULT_STATION_LIMIT')):
-    begin_filter()
-    station_cache.clear()
-    stations = []
-    stations_list_json = request('stations/search?order=name&reverse=false&limit=' + str(limit) + '&name=' + str(name))
-    for station_json in stations_list_json:
-        if check_station(station_json):
-            cur_station = Station(station_json)
-            station_cache[cur_station.id] = cur_station
-            stations.append(cur_station)
-    end_filter()
-    return stations
+def search(name, limit=None):
+    if limit is None:
+        limit = get_limit('DEFAULT_STATION_LIMIT')
+    return get_stations('stations/search?order=name&reverse=false&limit=' + str(limit) + '&name=' + str(name))
+
+
+def warm_up():
+    start = time.time()
+    try:
+        get_genre_directories()
+        get_country_directories()
+        get_language_directories()
+        get_stations_by_votes()
+    except (limiter.Busy, Unavailable) as ex:
+        logging.error("Could not warm up the Radiobrowser cache: %s", ex)
+        return
+    logging.info("Radiobrowser cache warmed up in %.1f s", time.time() - start)
+
+
+def save_snapshot():
+    cache_path = generic.get_cache_path(None)
+    if not cache_path or not response_cache:
+        return False
+    snapshot_file = cache_path + '/' + SNAPSHOT_FILE
+    with snapshot_lock:
+        try:
+            # replaced as a whole, a crash while writing keeps the previous snapshot
+            with cache_lock:
+                snapshot = dict(response_cache)
+            with open(snapshot_file + '.tmp', 'wb') as f:
+                pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(snapshot_file + '.tmp', snapshot_file)
+        except Exception as ex:
+            logging.error("Could not write Radiobrowser cache snapshot: %s", ex)
+            return False
+    logging.info("Saved %d Radiobrowser cache entries", len(snapshot))
+    return True
+
+
+def save_snapshot_later():
+    global snapshot_saved
+    with snapshot_lock:
+        if time.time() - snapshot_saved < SNAPSHOT_INTERVAL:
+            return
+        snapshot_saved = time.time()
+    threading.Thread(target=save_snapshot, name='radiobrowser-snapshot', daemon=True).start()
+
+
+def get_health():
+    health = breaker.to_dict()
+    health['cached_results'] = len(response_cache)
+    return health
+
+
+def restore_snapshot():
+    cache_path = generic.get_cache_path(None)
+    if not cache_path:
+        return False
+    start = time.time()
+    try:
+        with open(cache_path + '/' + SNAPSHOT_FILE, 'rb') as f:
+            snapshot = pickle.load(f)
+    except FileNotFoundError:
+        return False
+    except Exception as ex:
+        logging.error("Could not read Radiobrowser cache snapshot: %s", ex)
+        return False
+    with cache_lock:
+        # the restored results are older than the ones fetched since startup
+        for key, entry in sorted(snapshot.items(), key=lambda item: item[1][0], reverse=True):
+            if key not in response_cache:
+                response_cache[key] = entry
+                response_cache.move_to_end(key, last=False)
+        evict()
+    with stations_lock:
+        for kind, args, fingerprint in snapshot:
+            if kind == 'stations':
+                for station in snapshot[(kind, args, fingerprint)][1]:
+                    # older than the stations listed since startup
+                    if station.id not in station_cache and len(station_cache) < STATION_CACHE_SIZE:
+                        station_cache[station.id] = station
+                        station_cache.move_to_end(station.id, last=False)
+    logging.info("Restored %d Radiobrowser cache entries in %.0f ms", len(snapshot), (time.time() - start) * 1000)
+    return True
+
+
+circuit_open = metrics.CallbackMetric('ycast_upstream_circuit_open',
+                                      'Whether Radiobrowser API calls are stopped after repeated failures.', (),
+                                      lambda: {(): int(breaker.get_state() == 'open')})
@@ -1,8 +1,9 @@
 import logging
 import re
+import time
 
 import flask
-from flask import Flask, request, url_for, redirect, abort, make_response, render_template
+from flask import Flask, Response, request, url_for, redirect, abort, make_response, render_template, g
 
 import ycast.vtuner as vtuner
 import ycast.radiobrowser as radiobrowser
@@ -10,6 +11,13 @@ import ycast.my_stations as my_stations
 import ycast.generic as generic
 import ycast.station_icons as station_icons
 import ycast.my_filter as my_filter
+import ycast.metrics as metrics
+import ycast.tracing as tracing
+import ycast.my_devices as my_devices
+import ycast.stream_resolver as stream_resolver
+import ycast.stream_prober as stream_prober
+import ycast.stream_relay as stream_relay
+import ycast.limiter as limiter
 from ycast import my_recentlystation
 from ycast.my_recentlystation import signal_station_selected
 
@@ -18,6 +26,7 @@ PATH_PLAY = 'play'
 PATH_STATION = 'station'
 PATH_SEARCH = 'search'
 PATH_ICON = 'icon'
+PATH_RELAY = 'relay'
 PATH_MY_STATIONS = 'my_stations'
 PATH_RADIOBROWSER = 'radiobrowser'
 PATH_RADIOBROWSER_COUNTRY = 'country'
@@ -25,8 +34,21 @@ PATH_RADIOBROWSER_LANGUAGE = 'language'
 PATH_RADIOBROWSER_GENRE = 'genre'
 PATH_RADIOBROWSER_POPULAR = 'popular'
 
+PARAMETER_LETTER = 'letter'
+PARAMETER_RANGE = 'range'
+RANGE_NAME_LENGTH = 8
+AVR_PARAMETERS = ('mac', 'dlang', 'fver', 'vtuner', 'startitems', 'enditems', 'startItems', 'endItems', 'start',
+                  'howmany')
+BUCKET_CACHE_SIZE = 64
+# answered with a plain HTTP status if they fail, not with a vTuner page
+BINARY_ENDPOINTS = ('get_station_icon', 'get_stream_url', 'get_relayed_stream')
+
 station_tracking = False
+# streams are played through YCast, see stream_relay
+station_relay = False
 app = Flask(__name__)
+# id of a station list -> (station list, stations by first letter)
+bucket_cache = {}
 
 
 def run(config, address='0.0.0.0', port=8010):
@@ -37,12 +59,67 @@ def run(config, address='0.0.0.0', port=8010):
         logging.error("No permission to create socket. Are you trying to use ports below 1024 without elevated rights?")
 
 
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    tracing.start_trace(request.full_path)
+    radiobrowser.reset_cached()
+
+
+@app.after_request
+def observe_request(response):
+    tracing.finish_trace(my_filter.get_limit('SLOW_REQUEST_MS'))
+    if 'request_start' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.http_request_duration.observe(time.perf_counter() - g.request_start, route=route)
+        metrics.http_requests.inc(route=route, method=request.method, status=response.status_code)
+    if radiobrowser.is_cached():
+        response.headers.set('Warning', '110 - "Response is Stale"')
+    return response
+
+
+@app.errorhandler(limiter.Busy)
+@app.errorhandler(radiobrowser.Unavailable)
+def shed_load(error):
+    if isinstance(error, limiter.Busy):
+        message = "Busy, please try again"
+    else:
+        message = "Radiobrowser not reachable, please try again later"
+    logging.info("%s: %s", request.path, error)
+    # streams and icons are simply not available for now, receivers show a message for all other pages
+    if request.endpoint in BINARY_ENDPOINTS:
+        response = make_response(message, 503)
+        response.headers.set('Retry-After', '5')
+        return response
+    page = vtuner.Page()
+    page.add_item(vtuner.Display(message))
+    page.set_count(1)
+    page.dontcache = True
+    return page.to_string()
+
+
+def add_cached_marker(page):
+    # the listed entries are the last ones fetched, Radiobrowser could not be asked for current ones
+    if radiobrowser.is_cached():
+        page.set_notice("Radiobrowser not reachable, cached list")
+        page.dontcache = True
+
+
 def get_directories_page(subdir, directories, request_obj):
     page = vtuner.Page()
+    add_cached_marker(page)
+    buckets = None
+    if isinstance(directories, generic.DirectoryIndex):
+        buckets = directories.buckets
+        directories = directories.directories
     if len(directories) == 0:
         page.add_item(vtuner.Display("No entries found"))
         page.set_count(1)
         return page
+    bucket_directories, directories = get_buckets_or_items(directories, request_obj,
+                                                           lambda directory: directory.displayname, buckets)
+    if bucket_directories:
+        return get_bucket_directories_page(page, bucket_directories, request_obj)
     for directory in get_paged_elements(directories, request_obj.args):
         vtuner_directory = vtuner.Directory(directory.displayname,
                                             url_for(subdir, _external=True, directory=directory.name),
@@ -52,24 +129,107 @@ def get_directories_page(subdir, directories, request_obj):
     return page
 
 
-def get_stations_page(stations, request_obj):
+def get_stations_page(stations, request_obj, by_name=False):
+    # only lists ordered by name are split by first letter, ranked ones (votes, search, recently) keep their order
     page = vtuner.Page()
     page.add_item(vtuner.Previous(url_for('landing', _external=True)))
+    add_cached_marker(page)
+    if by_name and len(stations) > 0:
+        bucket_directories, stations = get_buckets_or_items(stations, request_obj, lambda station: station.name or '')
+        if bucket_directories:
+            return get_bucket_directories_page(page, bucket_directories, request_obj)
+    stations = stream_prober.rank_stations(stations)
     if len(stations) == 0:
         page.add_item(vtuner.Display("No stations found"))
         page.set_count(1)
         return page
-    for station in get_paged_elements(stations, request_obj.args):
-        vtuner_station = station.to_vtuner()
-        if station_tracking:
-            vtuner_station.set_trackurl(
-                request_obj.host_url + PATH_ROOT + '/' + PATH_PLAY + '?id=' + vtuner_station.uid)
-        vtuner_station.icon = request_obj.host_url + PATH_ROOT + '/' + PATH_ICON + '?id=' + vtuner_station.uid
-        page.add_item(vtuner_station)
+    paged_stations = get_paged_elements(stations, request_obj.args)
+    stream_prober.count_listed(paged_stations)
+    for station in paged_stations:
+        page.add_item(get_vtuner_station(station, request_obj))
     page.set_count(len(stations))
     return page
 
 
+def get_buckets_or_items(items, request_obj, get_name, buckets=None):
+    """
+    Lists with more than BUCKET_THRESHOLD entries are split by first letter, letters with more entries than that
+    into ranges. Returns the sub-directories to show, or None and the entries of the requested letter or range.
+    """
+    threshold = my_filter.get_limit('BUCKET_THRESHOLD')
+    if not threshold or len(items) <= threshold:
+        return None, items
+    if buckets is None:
+        buckets = get_buckets(items, get_name)
+    letter = request_obj.args.get(PARAMETER_LETTER)
+    if letter is None:
+        return [(bucket_letter, len(bucket), {PARAMETER_LETTER: bucket_letter})
+                for bucket_letter, bucket in buckets.items()], None
+    bucket = buckets.get(letter, [])
+    if len(bucket) <= threshold:
+        return None, bucket
+    ranges = [bucket[start:start + threshold] for start in range(0, len(bucket), threshold)]
+    position = request_obj.args.get(PARAMETER_RANGE, '')
+    if not position.isdigit():
+        return [(get_name(entries[0])[:RANGE_NAME_LENGTH] + ' - ' + get_name(entries[-1])[:RANGE_NAME_LENGTH],
+                 len(entries), {PARAMETER_LETTER: letter, PARAMETER_RANGE: position})
+                for position, entries in enumerate(ranges)], None
+    if int(position) >= len(ranges):
+        return None, []
+    return None, ranges[int(position)]
+
+
+def get_buckets(items, get_name):
+    # station lists are cached upstream and never modified, so their buckets are computed once
+    cached = bucket_cache.get(id(items))
+    if cached and cached[0] is items:
+        return cached[1]
+    buckets = {}
+    for item in items:
+        buckets.setdefault(generic.get_bucket(get_name(item)), []).append(item)
+    buckets = {letter: buckets[letter] for letter in sorted(buckets)}
+    if len(bucket_cache) >= BUCKET_CACHE_SIZE:
+        bucket_cache.clear()
+    bucket_cache[id(items)] = (items, buckets)
+    return buckets
+
+
+def get_bucket_directories_page(page, bucket_directories, request_obj):
+    # keep e.g. the search query, the AVR adds its own parameters again
+    arguments = {key: value for key, value in request_obj.args.items() if key not in AVR_PARAMETERS}
+    arguments.update(request_obj.view_args)
+    for title, item_count, parameters in get_paged_elements(bucket_directories, request_obj.args):
+        url = url_for(request_obj.endpoint, _external=True, **dict(arguments, **parameters))
+        page.add_item(vtuner.Directory(title, url, item_count))
+    page.set_count(len(bucket_directories))
+    return page
+
+
+def get_vtuner_station(station, request_obj):
+    resolution = stream_resolver.resolutions.get(station.url)
+    if resolution and resolution.codec and not station.codec:
+        # e.g. 'My Stations', as found by the stream prober
+        station = station.replace(codec=resolution.codec, bitrate=resolution.bitrate or station.bitrate)
+    vtuner_station = station.to_vtuner()
+    if station_tracking:
+        vtuner_station.set_trackurl(request_obj.host_url + PATH_ROOT + '/' + PATH_PLAY + '?id=' + vtuner_station.uid)
+    else:
+        vtuner_station.url = get_receiver_url(station, request_obj)
+    vtuner_station.icon = request_obj.host_url + PATH_ROOT + '/' + PATH_ICON + '?id=' + vtuner_station.uid
+    return vtuner_station
+
+
+def get_receiver_url(station, request_obj, wait=False):
+    if wait:
+        url = stream_resolver.get_stream_url(station.url)
+    else:
+        url = stream_resolver.get_cached_stream_url(station.url)
+    # the HTTP variant is checked when the station is played, not for every station listed
+    if station_relay or stream_relay.needs_bridge(url, resolve=wait):
+        return request_obj.host_url + PATH_ROOT + '/' + PATH_RELAY + '?id=' + station.id
+    return vtuner.strip_https(url)
+
+
 def get_paged_elements(items, requestargs):
     if requestargs.get('startitems'):
         offset = int(requestargs.get('startitems')) - 1
@@ -98,14 +258,18 @@ def get_paged_elements(items, requestargs):
     return items[offset:limit]
 
 
+def get_mac():
+    return my_devices.get_mac(request.args.get('mac'), request.remote_addr)
+
+
 def get_station_by_id(stationid, additional_info=False):
     station_id_prefix = generic.get_stationid_prefix(stationid)
     if station_id_prefix == my_stations.ID_PREFIX:
-        return my_stations.get_station_by_id(stationid)
+        return my_stations.get_station_by_id(stationid, get_mac())
     elif station_id_prefix == radiobrowser.ID_PREFIX:
         station = radiobrowser.get_station_by_id(stationid)
-        if additional_info:
-            station.get_playable_url()
+        if station and additional_info:
+            station = station.get_playable_url()
         return station
     return None
 
@@ -139,37 +303,51 @@ def upstream(path):
 @app.route('/control/filter/<path:item>',
            methods=['POST','GET'])
 def set_filters(item):
-    update_limits=False
     # POST updates the whitelist or blacklist, GET just returns the current attributes/values.
     myfilter={}
+    list_name=None
     if item.endswith('blacklist'):
-        myfilter=my_filter.black_list
+        list_name='black_list'
     if item.endswith('whitelist'):
-        myfilter=my_filter.white_list
+        list_name='white_list'
+    if list_name:
+        myfilter=dict(getattr(my_filter.get_config(), list_name))
     if item.endswith('limits'):
         myfilter=my_filter.get_limit_list()
-        update_limits=True
     if request.method == 'POST':
         content_type = request.headers.get('Content-Type')
         if (content_type == 'application/json'):
             json = request.json
         else:
             return  abort(400,'Content-Type not supported!: ' + item)
-        if update_limits:
+        if item.endswith('limits'):
             myfilter=my_filter.set_limits(json)
-        else:
-            for j in json:
-                # Attribute with null value removes item from the list otherwise add the attribute or update the value
-                if json[j] == None:
-                    myfilter.pop(j, None)
-                else:
-                    myfilter[j]=json[j]
+            stream_prober.reschedule()
+        elif list_name:
+            # Attribute with null value removes item from the list otherwise add the attribute or update the value
+            myfilter=my_filter.update_filter(list_name, json)
         my_filter.write_filter_config()
+        radiobrowser.invalidate(my_filter.get_config())
     json=flask.jsonify(myfilter)
     return json
 
+@app.route('/control/health',
+           methods=['GET'])
+def get_health():
+    # YCast itself is up, Radiobrowser may be degraded (served from the cache)
+    return flask.jsonify({'radiobrowser': radiobrowser.get_health()})
+
+
+@app.route('/metrics',
+           methods=['GET'])
+def get_metrics():
+    response = make_response(metrics.to_text())
+    response.headers.set('Content-Type', metrics.CONTENT_TYPE)
+    return response
+
+
 @app.route('/api/<path:path>',
-           methods=['GET', 'POST'])
+           methods=['GET', 'POST', 'PATCH'])
 def landing_api(path):
     if request.method == 'GET':
         if path.endswith('stations'):
@@ -195,12 +373,15 @@ def landing_api(path):
 
         if path.endswith('bookmarks'):
             category = request.args.get('category')
+            version = my_stations.get_bookmarks_version()
             stations = my_stations.get_all_bookmarks_stations()
             if stations is not None:
                 stations_dict = []
                 for station in stations:
                     stations_dict.append(station.to_dict())
-                return flask.jsonify(stations_dict)
+                response = flask.jsonify(stations_dict)
+                response.set_etag(version)
+                return response
 
         if path.endswith('paramlist'):
             category = request.args.get('category')
@@ -219,10 +400,27 @@ def landing_api(path):
             content_type = request.headers.get('Content-Type')
             if (content_type == 'application/json'):
                 json = request.json
-                return flask.jsonify(my_stations.putBookmarkJson(json))
+                response = flask.jsonify(my_stations.putBookmarkJson(json))
+                response.set_etag(my_stations.get_bookmarks_version())
+                return response
             else:
                 return  abort(400,'Content-Type not supported!: ' + path)
 
+    if request.method == 'PATCH' and path.endswith('bookmarks'):
+        if request.headers.get('Content-Type') != 'application/json':
+            return abort(400, 'Content-Type not supported!: ' + path)
+        # If-Match is optional, without it the operations are applied to the current bookmarks
+        expected_version = request.headers.get('If-Match', '').strip('"') or None
+        try:
+            version = my_stations.patch_bookmarks(request.json, expected_version)
+        except ValueError as e:
+            return abort(400, str(e))
+        if version is None:
+            return abort(412, 'Bookmarks have been changed, reload them')
+        response = flask.jsonify({'version': version})
+        response.set_etag(version)
+        return response
+
     return abort(400,'Not implemented: ' + path)
 
 
@@ -241,23 +439,19 @@ def landing(path=''):
     logging.debug('===============================================================')
     page = vtuner.Page()
 
+    mac = get_mac()
     page.add_item(vtuner.Directory('Radiobrowser', url_for('radiobrowser_landing', _external=True), 4))
 
     page.add_item(vtuner.Directory('My Stations', url_for('my_stations_landing', _external=True),
-                                   len(my_stations.get_category_directories())))
+                                   len(my_stations.get_category_directories(mac))))
 
-    stations = my_recentlystation.get_stations_by_vote()
+    stations = my_recentlystation.get_stations_by_vote(mac)
     if stations and len(stations) > 0:
         # make blank line (display is not shown)
         page.add_item(vtuner.Spacer())
 
         for station in stations:
-            vtuner_station = station.to_vtuner()
-            if station_tracking:
-                vtuner_station.set_trackurl(
-                    request.host_url + PATH_ROOT + '/' + PATH_PLAY + '?id=' + vtuner_station.uid)
-            vtuner_station.icon = request.host_url + PATH_ROOT + '/' + PATH_ICON + '?id=' + vtuner_station.uid
-            page.add_item(vtuner_station)
+            page.add_item(get_vtuner_station(station, request))
 
     else:
         page.add_item(vtuner.Display("'My Stations' feature not configured."))
@@ -269,7 +463,7 @@ def landing(path=''):
            methods=['GET', 'POST'])
 def my_stations_landing():
     logging.debug('===============================================================')
-    directories = my_stations.get_category_directories()
+    directories = my_stations.get_category_directories(get_mac())
     return get_directories_page('my_stations_category', directories, request).to_string()
 
 
@@ -277,7 +471,7 @@ def my_stations_landing():
            methods=['GET', 'POST'])
 def my_stations_category(directory):
     logging.debug('===============================================================')
-    stations = my_stations.get_stations_by_category(directory)
+    stations = my_stations.get_stations_by_category(directory, get_mac())
     return get_stations_page(stations, request).to_string()
 
 
@@ -285,16 +479,27 @@ def my_stations_category(directory):
            methods=['GET', 'POST'])
 def radiobrowser_landing():
     logging.debug('===============================================================')
+    directories = []
+    error = None
+    # every list that is available (or cached) is shown, even if others are not
+    for title, endpoint, get_list in (('Genres', 'radiobrowser_genres', radiobrowser.get_genre_directories),
+                                      ('Countries', 'radiobrowser_countries', radiobrowser.get_country_directories),
+                                      ('Languages', 'radiobrowser_languages', radiobrowser.get_language_directories),
+                                      ('Most Popular', 'radiobrowser_popular', radiobrowser.get_stations_by_votes)):
+        try:
+            directories.append(vtuner.Directory(title, url_for(endpoint, _external=True), len(get_list())))
+        except (limiter.Busy, radiobrowser.Unavailable) as ex:
+            error = ex
+    if not directories:
+        raise error
     page = vtuner.Page()
-    page.add_item(vtuner.Directory('Genres', url_for('radiobrowser_genres', _external=True),
-                                   len(radiobrowser.get_genre_directories())))
-    page.add_item(vtuner.Directory('Countries', url_for('radiobrowser_countries', _external=True),
-                                   len(radiobrowser.get_country_directories())))
-    page.add_item(vtuner.Directory('Languages', url_for('radiobrowser_languages', _external=True),
-                                   len(radiobrowser.get_language_directories())))
-    page.add_item(vtuner.Directory('Most Popular', url_for('radiobrowser_popular', _external=True),
-                                   len(radiobrowser.get_stations_by_votes())))
-    page.set_count(4)
+    add_cached_marker(page)
+    if error:
+        page.set_notice("Radiobrowser not reachable, some lists are missing")
+        page.dontcache = True
+    for directory in directories:
+        page.add_item(directory)
+    page.set_count(len(directories))
     return page.to_string()
 
 
@@ -302,7 +507,7 @@ def radiobrowser_landing():
            methods=['GET', 'POST'])
 def radiobrowser_countries():
     logging.debug('===============================================================')
-    directories = radiobrowser.get_country_directories()
+    directories = radiobrowser.get_country_index()
     return get_directories_page('radiobrowser_country_stations', directories, request).to_string()
 
 
@@ -311,14 +516,14 @@ def radiobrowser_countries():
 def radiobrowser_country_stations(directory):
     logging.debug('===============================================================')
     stations = radiobrowser.get_stations_by_country(directory)
-    return get_stations_page(stations, request).to_string()
+    return get_stations_page(stations, request, by_name=True).to_string()
 
 
 @app.route('/' + PATH_ROOT + '/' + PATH_RADIOBROWSER + '/' + PATH_RADIOBROWSER_LANGUAGE + '/',
            methods=['GET', 'POST'])
 def radiobrowser_languages():
     logging.debug('===============================================================')
-    directories = radiobrowser.get_language_directories()
+    directories = radiobrowser.get_language_index()
     return get_directories_page('radiobrowser_language_stations', directories, request).to_string()
 
 
@@ -327,14 +532,14 @@ def radiobrowser_languages():
 def radiobrowser_language_stations(directory):
     logging.debug('===============================================================')
     stations = radiobrowser.get_stations_by_language(directory)
-    return get_stations_page(stations, request).to_string()
+    return get_stations_page(stations, request, by_name=True).to_string()
 
 
 @app.route('/' + PATH_ROOT + '/' + PATH_RADIOBROWSER + '/' + PATH_RADIOBROWSER_GENRE + '/',
            methods=['GET', 'POST'])
 def radiobrowser_genres():
     logging.debug('===============================================================')
-    directories = radiobrowser.get_genre_directories()
+    directories = radiobrowser.get_genre_index()
     return get_directories_page('radiobrowser_genre_stations', directories, request).to_string()
 
 
@@ -343,7 +548,7 @@ def radiobrowser_genres():
 def radiobrowser_genre_stations(directory):
     logging.debug('===============================================================')
     stations = radiobrowser.get_stations_by_genre(directory)
-    return get_stations_page(stations, request).to_string()
+    return get_stations_page(stations, request, by_name=True).to_string()
 
 
 @app.route('/' + PATH_ROOT + '/' + PATH_RADIOBROWSER + '/' + PATH_RADIOBROWSER_POPULAR + '/',
@@ -383,7 +588,24 @@ def get_stream_url():
         logging.error("Could not get station with id '%s'", stationid)
         abort(404)
     logging.debug("Station with ID '%s' requested", station.id)
-    return vtuner_redirect(station.url)
+    return vtuner_redirect(get_receiver_url(station, request, wait=True))
+
+
+@app.route('/' + PATH_ROOT + '/' + PATH_RELAY,
+           methods=['GET'])
+def get_relayed_stream():
+    stationid = request.args.get('id')
+    if not stationid:
+        logging.error("Relayed stream without station ID requested")
+        abort(400)
+    station = get_station_by_id(stationid)
+    if not station:
+        logging.error("Could not get station with id '%s'", stationid)
+        abort(404)
+    relay = stream_relay.get_relay(stream_resolver.get_stream_url(station.url))
+    if not relay:
+        abort(502)
+    return Response(relay.iter_chunks(), content_type=relay.content_type, direct_passthrough=True)
 
 
 @app.route('/' + PATH_ROOT + '/' + PATH_STATION,
@@ -401,12 +623,8 @@ def get_station_info():
         page.add_item(vtuner.Display("Station not found"))
         page.set_count(1)
         return page.to_string()
-    vtuner_station = station.to_vtuner()
-    if station_tracking:
-        vtuner_station.set_trackurl(request.host_url + PATH_ROOT + '/' + PATH_PLAY + '?id=' + vtuner_station.uid)
-    vtuner_station.icon = request.host_url + PATH_ROOT + '/' + PATH_ICON + '?id=' + vtuner_station.uid
     page = vtuner.Page()
-    page.add_item(vtuner_station)
+    page.add_item(get_vtuner_station(station, request))
     page.set_count(1)
     return page.to_string()
 
@@ -423,7 +641,7 @@ def get_station_icon():
     if not station:
         logging.error("Could not get station with id '%s'", stationid)
         abort(404)
-    signal_station_selected(station.name, station.url, station.icon)
+    signal_station_selected(station.name, station.url, station.icon, get_mac())
     if not hasattr(station, 'icon') or not station.icon:
         logging.warning("No icon information found for station with id '%s'", stationid)
         abort(404)
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+Optional SQLite storage for bookmarks ('My Stations'), recently played stations and their votes.
+
+    python -m ycast.sqlite_storage <database> --import-yaml <stations.yml> [<recently.yml>]
+    python -m ycast.sqlite_storage <database> --export-yaml <stations.yml> [<recently.yml>]
+"""
+import argparse
+import atexit
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS categories (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    position INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS bookmarks (
+    id INTEGER PRIMARY KEY,
+    station_id TEXT NOT NULL,
+    category_id INTEGER NOT NULL REFERENCES categories(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    url TEXT NOT NULL,
+    icon TEXT,
+    position INTEGER NOT NULL,
+    UNIQUE (category_id, name)
+);
+CREATE INDEX IF NOT EXISTS bookmarks_station_id ON bookmarks(station_id);
+CREATE INDEX IF NOT EXISTS bookmarks_category ON bookmarks(category_id, position);
+CREATE TABLE IF NOT EXISTS recently (
+    name TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    icon TEXT,
+    position INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS recently_position ON recently(position);
+CREATE TABLE IF NOT EXISTS votes (
+    name TEXT PRIMARY KEY REFERENCES recently(name) ON DELETE CASCADE,
+    vote REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS votes_vote ON votes(vote DESC);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+SCHEMA_VERSION = 1
+
+database_file = None
+# one connection for all threads, used by one thread at a time
+shared_connection = None
+connection_lock = threading.RLock()
+
+
+def init_database(file_name):
+    global database_file
+    close_database()
+    database_file = file_name
+    with connect() as connection:
+        connection.executescript(SCHEMA)
+        connection.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+    logging.info("Using SQLite storage %s", file_name)
+
+
+def close_database():
+    global shared_connection
+    with connection_lock:
+        if shared_connection is not None:
+            shared_connection.close()
+            shared_connection = None
+
+
+def is_enabled():
+    return database_file is not None
+
+
+@contextmanager
+def connect():
+    global shared_connection
+    with connection_lock:
+        if shared_connection is None:
+            # transactions are handled explicitly
+            shared_connection = sqlite3.connect(database_file, isolation_level=None, timeout=10,
+                                                check_same_thread=False)
+            shared_connection.execute('PRAGMA journal_mode=WAL')
+            shared_connection.execute('PRAGMA foreign_keys=ON')
+        yield shared_connection
+
+
+@contextmanager
+def transaction():
+    with connect() as connection:
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+
+def get_categories():
+    with connect() as connection:
+        return connection.execute(
+            'SELECT categories.name, COUNT(bookmarks.id) FROM categories '
+            'LEFT JOIN bookmarks ON bookmarks.category_id = categories.id '
+            'GROUP BY categories.id ORDER BY categories.position').fetchall()
+
+
+def get_bookmarks(category=None):
+    query = 'SELECT categories.name, bookmarks.name, bookmarks.url, bookmarks.icon FROM bookmarks ' \
+            'JOIN categories ON categories.id = bookmarks.category_id'
+    with connect() as connection:
+        if category is None:
+            return connection.execute(query + ' ORDER BY categories.position, bookmarks.position').fetchall()
+        return connection.execute(query + ' WHERE categories.name = ? ORDER BY bookmarks.position',
+                                  (category,)).fetchall()
+
+
+def get_bookmark_by_station_id(station_id):
+    with connect() as connection:
+        return connection.execute(
+            'SELECT categories.name, bookmarks.name, bookmarks.url, bookmarks.icon FROM bookmarks '
+            'JOIN categories ON categories.id = bookmarks.category_id '
+            'WHERE bookmarks.station_id = ? ORDER BY categories.position LIMIT 1', (station_id,)).fetchone()
+
+
+def put_bookmarks(bookmarks):
+    """Replaces all bookmarks by the given (category, name, url, icon, station_id) rows in one transaction."""
+    with transaction() as connection:
+        connection.execute('DELETE FROM bookmarks')
+        connection.execute('DELETE FROM categories')
+        insert_bookmarks(connection, bookmarks)
+        return increment_bookmarks_version(connection)
+
+
+def get_bookmarks_version(connection=None):
+    if connection is None:
+        with connect() as connection:
+            return get_bookmarks_version(connection)
+    row = connection.execute("SELECT value FROM settings WHERE key = 'bookmarks_version'").fetchone()
+    return row[0] if row else '0'
+
+
+def increment_bookmarks_version(connection):
+    version = str(int(get_bookmarks_version(connection)) + 1)
+    connection.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('bookmarks_version', ?)", (version,))
+    return version
+
+
+def patch_bookmarks(operations, version, get_station_id):
+    """
+    Applies bookmark operations (see my_stations.patch_bookmarks) in one transaction.
+    Returns the new version or None if the bookmarks are not at the expected version.
+    """
+    with transaction() as connection:
+        if version is not None and version != get_bookmarks_version(connection):
+            return None
+        for operation in operations:
+            apply_operation(connection, operation, get_station_id)
+        return increment_bookmarks_version(connection)
+
+
+def apply_operation(connection, operation, get_station_id):
+    op = operation['op']
+    if op == 'rename_category':
+        if connection.execute('SELECT id FROM categories WHERE name = ?', (operation['to'],)).fetchone():
+            raise ValueError("Category '%s' exists" % operation['to'])
+        if not connection.execute('UPDATE categories SET name = ? WHERE name = ?',
+                                  (operation['to'], operation['category'])).rowcount:
+            raise ValueError("Category '%s' not found" % operation['category'])
+        return
+    if op == 'add':
+        category_id = get_category_id(connection, operation['category'])
+        connection.execute('INSERT OR REPLACE INTO bookmarks (station_id, category_id, name, url, icon, position) '
+                           'VALUES (?, ?, ?, ?, ?, ?)',
+                           (get_station_id(operation['name'], operation['url']), category_id, operation['name'],
+                            operation['url'], operation.get('icon'), get_next_position(connection, category_id)))
+        return
+    row = connection.execute('SELECT bookmarks.id, bookmarks.category_id, bookmarks.url FROM bookmarks '
+                             'JOIN categories ON categories.id = bookmarks.category_id '
+                             'WHERE categories.name = ? AND bookmarks.name = ?',
+                             (operation['category'], operation['name'])).fetchone()
+    if not row:
+        raise ValueError("Bookmark '%s' not found in '%s'" % (operation['name'], operation['category']))
+    bookmark_id, category_id, url = row
+    if op == 'remove':
+        connection.execute('DELETE FROM bookmarks WHERE id = ?', (bookmark_id,))
+    elif op == 'rename':
+        connection.execute('DELETE FROM bookmarks WHERE category_id = ? AND name = ? AND id != ?',
+                           (category_id, operation['to'], bookmark_id))
+        connection.execute('UPDATE bookmarks SET name = ?, station_id = ? WHERE id = ?',
+                           (operation['to'], get_station_id(operation['to'], url), bookmark_id))
+    elif op == 'move':
+        target_id = get_category_id(connection, operation.get('to', operation['category']))
+        connection.execute('DELETE FROM bookmarks WHERE category_id = ? AND name = ? AND id != ?',
+                           (target_id, operation['name'], bookmark_id))
+        bookmark_ids = [row[0] for row in connection.execute(
+            'SELECT id FROM bookmarks WHERE category_id = ? AND id != ? ORDER BY position', (target_id, bookmark_id))]
+        position = operation.get('position')
+        bookmark_ids.insert(len(bookmark_ids) if position is None else position, bookmark_id)
+        for position, renumbered_id in enumerate(bookmark_ids):
+            connection.execute('UPDATE bookmarks SET category_id = ?, position = ? WHERE id = ?',
+                               (target_id, position, renumbered_id))
+    else:
+        raise ValueError("Unknown operation '%s'" % op)
+    # categories without bookmarks are not kept, like in stations.yml written by the web UI
+    connection.execute('DELETE FROM categories WHERE id = ? AND NOT EXISTS '
+                       '(SELECT 1 FROM bookmarks WHERE category_id = ?)', (category_id, category_id))
+
+
+def get_category_id(connection, category):
+    row = connection.execute('SELECT id FROM categories WHERE name = ?', (category,)).fetchone()
+    if row:
+        return row[0]
+    position = connection.execute('SELECT COALESCE(MAX(position) + 1, 0) FROM categories').fetchone()[0]
+    return connection.execute('INSERT INTO categories (name, position) VALUES (?, ?)',
+                              (category, position)).lastrowid
+
+
+def get_next_position(connection, category_id):
+    return connection.execute('SELECT COALESCE(MAX(position) + 1, 0) FROM bookmarks WHERE category_id = ?',
+                              (category_id,)).fetchone()[0]
+
+
+def insert_bookmarks(connection, bookmarks):
+    category_ids = {}
+    for position, (category, name, url, icon, station_id) in enumerate(bookmarks):
+        category_id = category_ids.get(category)
+        if category_id is None:
+            category_id = connection.execute('INSERT INTO categories (name, position) VALUES (?, ?)',
+                                             (category, len(category_ids))).lastrowid
+            category_ids[category] = category_id
+        connection.execute('INSERT OR REPLACE INTO bookmarks (station_id, category_id, name, url, icon, position) '
+                           'VALUES (?, ?, ?, ?, ?, ?)', (station_id, category_id, name, url, icon, position))
+
+
+def get_recently():
+    with connect() as connection:
+        return connection.execute(
+            'SELECT recently.name, recently.url, recently.icon, COALESCE(votes.vote, 0) FROM recently '
+            'LEFT JOIN votes ON votes.name = recently.name ORDER BY recently.position').fetchall()
+
+
+def get_recently_directory_name():
+    with connect() as connection:
+        row = connection.execute("SELECT value FROM settings WHERE key = 'recently_directory'").fetchone()
+    return row[0] if row else None
+
+
+def put_recently(directory_name, recently):
+    """Replaces the recently played stations by the given (name, url, icon, vote) rows in one transaction."""
+    with transaction() as connection:
+        connection.execute('DELETE FROM recently')
+        for position, (name, url, icon, vote) in enumerate(recently):
+            connection.execute('INSERT OR REPLACE INTO recently (name, url, icon, position) VALUES (?, ?, ?, ?)',
+                               (name, url, icon, position))
+            connection.execute('INSERT OR REPLACE INTO votes (name, vote) VALUES (?, ?)', (name, vote))
+        connection.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('recently_directory', ?)",
+                           (directory_name,))
+
+
+def is_empty():
+    with connect() as connection:
+        return connection.execute('SELECT COUNT(*) FROM categories').fetchone()[0] == 0 and \
+            connection.execute('SELECT COUNT(*) FROM recently').fetchone()[0] == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import or export the YCast SQLite storage from/to YAML files')
+    parser.add_argument('database', help='SQLite database file')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--import-yaml', action='store_true', dest='import_yaml',
+                       help='Replace the database content by the YAML files')
+    group.add_argument('--export-yaml', action='store_true', dest='export_yaml',
+                       help='Write the database content to the YAML files')
+    parser.add_argument('stations_file', help='Bookmarks file (stations.yml format)')
+    parser.add_argument('recently_file', nargs='?', default=None, help='Recently played stations file')
+    arguments = parser.parse_args()
+    from ycast import my_stations, my_recentlystation
+    init_database(arguments.database)
+    atexit.register(close_database)
+    if arguments.import_yaml:
+        my_stations.import_yaml_file(arguments.stations_file)
+        if arguments.recently_file:
+            my_recentlystation.import_yaml_file(arguments.recently_file)
+    else:
+        my_stations.export_yaml_file(arguments.stations_file)
+        if arguments.recently_file:
+            my_recentlystation.export_yaml_file(arguments.recently_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,8 @@
+// version (ETag) of the bookmarks shown, changes are only applied by the server to this version
+var bookmarksVersion = null;
+// PATCH requests are sent one after the other, each with the version returned for the previous one
+var bookmarksPatches = Promise.resolve();
+
 window.onload = function () {
     document.getElementById('idRequestSrc').value = 'recently';
     document.getElementById('idLanOrCountSelect').disabled = true;
@@ -88,7 +93,10 @@ function requestStationList(category, param, isbookmarklist) {
     myOldList.parentNode.replaceChild(myList, myOldList);
 
     fetch(myRequest)
-        .then(response => response.json())
+        .then(response => {
+            if (isbookmarklist) bookmarksVersion = response.headers.get('ETag');
+            return response.json();
+        })
         .then(data => {
             for (const station of data) {
                 countall = countall + 1;
@@ -130,10 +138,11 @@ function requestStationList(category, param, isbookmarklist) {
 
 function deleteElement(event, objElem) {
     if (objElem) {
+        let station = JSON.parse(objElem.dataset.json);
         objElem.remove();
         refreshFilteredList(document.getElementById("bookmarkList"), document.getElementById('idcategory').value, true);
         setBookmarkcategoryList();
-        saveBookmarks();
+        patchBookmarks([{op: 'remove', category: station.description, name: station.name}]);
     }
 }
 
@@ -159,7 +168,9 @@ function copyElementToBookmark(event, objElem) {
         myList.appendChild(listItem);
         refreshFilteredList(document.getElementById("bookmarkList"), document.getElementById('idcategory').value, true);
         setBookmarkcategoryList();
-        saveBookmarks();
+        patchBookmarks([{
+            op: 'add', category: station.description, name: station.name, url: station.url, icon: station.icon
+        }]);
     }
 }
 
@@ -355,25 +366,26 @@ function keyUpEvent(e, objElem) {
     }
 }
 
-function saveBookmarks() {
-    var bookmarkJsonlist = []
-    var bookmarkList = Array.from(document.getElementById("bookmarkList").childNodes);
-    bookmarkList.forEach(function (listItem) {
-        if (listItem.dataset.isemptyelement === 'false') {
-            station = JSON.parse(listItem.dataset.json)
-            bookmarkJsonlist.push(station)
-        }
-    })
-    var data = JSON.stringify(bookmarkJsonlist)
-
-    var xhr = new XMLHttpRequest();
-    xhr.open("POST", 'api/bookmarks', true);
-    xhr.setRequestHeader("Content-Type", "application/json");
-    xhr.onreadystatechange = function () {
-        if (xhr.readyState === 4 && xhr.status === 200) {
-            var json = JSON.parse(xhr.responseText);
-            console.log(json);
-        }
-    };
-    xhr.send(data);
+function patchBookmarks(operations) {
+    bookmarksPatches = bookmarksPatches.then(function () {
+        return new Promise(function (resolve) {
+            var xhr = new XMLHttpRequest();
+            xhr.open("PATCH", 'api/bookmarks', true);
+            xhr.setRequestHeader("Content-Type", "application/json");
+            if (bookmarksVersion) xhr.setRequestHeader("If-Match", bookmarksVersion);
+            xhr.onreadystatechange = function () {
+                if (xhr.readyState === 4) {
+                    if (xhr.status === 200) {
+                        bookmarksVersion = xhr.getResponseHeader('ETag');
+                    } else {
+                        // changed elsewhere (412) or rejected: show the bookmarks as stored on the server
+                        console.error(xhr.status, xhr.responseText);
+                        requestStationList('', '', true);
+                    }
+                    resolve();
+                }
+            };
+            xhr.send(JSON.stringify(operations));
+        });
+    });
 }
@@ -1,47 +1,38 @@
 import logging
-import requests
 import io
 import os
-
-from PIL import Image
+import tempfile
 
 import ycast.generic as generic
-from ycast import __version__
+from ycast import __version__, metrics, tracing, limiter
 
 MAX_SIZE = 290
 CACHE_NAME = 'icons'
+TIMEOUT = (3, 10)
+
+
+icon_flight = metrics.register_single_flight(generic.SingleFlight('Station icons'))
 
 
 def get_icon(station):
+    with tracing.span('station_icons.get_icon'):
+        return get_cached_icon(station)
+
+
+def get_cached_icon(station):
     cache_path = generic.get_cache_path(CACHE_NAME)
     if not cache_path:
         return None
 
 # make icon filename from favicon-adress
     station_icon_file = cache_path + '/' + generic.get_checksum(station.icon) + '.jpg'
-    if not os.path.exists(station_icon_file):
+    if os.path.exists(station_icon_file):
+        metrics.icon_cache_requests.inc(result='hit')
+    else:
+        metrics.icon_cache_requests.inc(result='miss')
         logging.debug("Station icon cache miss. Fetching and converting station icon for station id '%s'", station.id)
-        headers = {'User-Agent': generic.USER_AGENT + '/' + __version__}
-        try:
-            response = requests.get(station.icon, headers=headers)
-        except requests.exceptions.ConnectionError as err:
-            logging.debug("Connection to station icon URL failed (%s)", err)
-            return None
-        if response.status_code != 200:
-            logging.debug("Could not get station icon data from %s (HTML status %s)",
-                          station.icon, response.status_code)
-            return None
-        try:
-            image = Image.open(io.BytesIO(response.content))
-            image = image.convert("RGB")
-            if image.size[0] > image.size[1]:
-                ratio = MAX_SIZE / image.size[0]
-            else:
-                ratio = MAX_SIZE / image.size[1]
-            image = image.resize((int(image.size[0] * ratio), int(image.size[1] * ratio)), Image.ANTIALIAS)
-            image.save(station_icon_file, format="JPEG")
-        except Exception as e:
-            logging.error("Station icon conversion error (%s)", e)
+        # concurrent requests for the same favicon share one download and conversion
+        if not icon_flight.do(station_icon_file, fetch_icon, station.icon, station_icon_file):
             return None
     try:
         with open(station_icon_file, 'rb') as file:
@@ -51,3 +42,51 @@ def get_icon(station):
                       station_icon_file)
         return None
     return image_conv
+
+
+def fetch_icon(icon_url, station_icon_file):
+    # only needed on a cache miss, Pillow in particular is slow to import on small boards
+    import requests
+    from PIL import Image
+    headers = {'User-Agent': generic.USER_AGENT + '/' + __version__}
+    try:
+        with limiter.favicons.limit():
+            response = requests.get(icon_url, headers=headers, timeout=TIMEOUT)
+    except requests.exceptions.RequestException as err:
+        logging.debug("Connection to station icon URL failed (%s)", err)
+        return False
+    if response.status_code != 200:
+        logging.debug("Could not get station icon data from %s (HTML status %s)",
+                      icon_url, response.status_code)
+        return False
+    try:
+        with limiter.images.limit():
+            image = Image.open(io.BytesIO(response.content))
+            image = image.convert("RGB")
+            if image.size[0] > image.size[1]:
+                ratio = MAX_SIZE / image.size[0]
+            else:
+                ratio = MAX_SIZE / image.size[1]
+            image = image.resize((int(image.size[0] * ratio), int(image.size[1] * ratio)), Image.LANCZOS)
+            save_icon(image, station_icon_file)
+    except limiter.Busy:
+        raise
+    except Exception as e:
+        logging.error("Station icon conversion error (%s)", e)
+        return False
+    return True
+
+
+def save_icon(image, station_icon_file):
+    # written next to the cached icon and renamed, other requests never read a partly written file
+    fd, temp_name = tempfile.mkstemp(dir=os.path.dirname(station_icon_file), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            image.save(file, format="JPEG")
+        os.replace(temp_name, station_icon_file)
+    except BaseException:
+        try:
+            os.unlink(temp_name)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,86 @@
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from ycast import metrics, stream_resolver
+from ycast.my_filter import get_limit
+
+PROBE_CONCURRENCY = 8
+# most often listed station URLs probed besides the bookmarks
+PROBE_TOP_LISTED = 200
+LISTED_SIZE = 10000
+
+# station url -> number of times it was listed
+listed = Counter()
+listed_lock = threading.Lock()
+# set when PROBE_INTERVAL may have changed
+wakeup = threading.Event()
+
+
+def count_listed(stations):
+    with listed_lock:
+        listed.update(station.url for station in stations)
+        if len(listed) > LISTED_SIZE:
+            most_common = listed.most_common(PROBE_TOP_LISTED)
+            listed.clear()
+            listed.update(dict(most_common))
+
+
+def get_probe_urls():
+    from ycast import my_stations
+    urls = dict.fromkeys(station.url for station in my_stations.get_all_bookmarks_stations())
+    with listed_lock:
+        urls.update(dict.fromkeys(url for url, _ in listed.most_common(PROBE_TOP_LISTED)))
+    return list(urls)
+
+
+def probe(urls):
+    """Checks the stream URLs with at most PROBE_CONCURRENCY connections at a time, returns the dead ones."""
+    with ThreadPoolExecutor(max_workers=PROBE_CONCURRENCY, thread_name_prefix='stream-prober') as pool:
+        resolutions = list(pool.map(stream_resolver.resolve, urls))
+    dead = [resolution.url for resolution in resolutions if not resolution.healthy]
+    metrics.stream_probes.inc(len(resolutions) - len(dead), result='ok')
+    metrics.stream_probes.inc(len(dead), result='dead')
+    logging.info("Probed %d streams, %d dead", len(resolutions), len(dead))
+    return dead
+
+
+def is_dead(url):
+    # the last probe result counts, however old it is
+    resolution = stream_resolver.resolutions.get(url)
+    return resolution is not None and not resolution.healthy
+
+
+def rank_stations(stations):
+    """Moves dead stations to the end of the list, or drops them with HIDE_DEAD_STATIONS."""
+    dead = [station for station in stations if is_dead(station.url)]
+    if not dead:
+        return stations
+    alive = [station for station in stations if not is_dead(station.url)]
+    if get_limit('HIDE_DEAD_STATIONS'):
+        return alive
+    return alive + dead
+
+
+def start():
+    def run():
+        probed = 0
+        while True:
+            # read on every round, a reload can enable, disable or change the probing
+            interval = get_limit('PROBE_INTERVAL')
+            if interval > 0 and time.time() - probed >= interval:
+                probed = time.time()
+                try:
+                    probe(get_probe_urls())
+                except Exception as ex:
+                    logging.error("Stream probing failed: %s", ex)
+            wakeup.wait(probed + interval - time.time() if interval > 0 else None)
+            wakeup.clear()
+    threading.Thread(target=run, name='stream-prober', daemon=True).start()
+
+
+def reschedule():
+    """Applies a changed PROBE_INTERVAL without waiting for the current one to end."""
+    wakeup.set()
@@ -0,0 +1,159 @@
+import logging
+import threading
+import time
+
+from ycast import __version__, generic, metrics, stream_resolver
+import ycast.vtuner as vtuner
+
+CHUNK_SIZE = 16 * 1024
+# chunks kept per stream, a client falling further behind skips the oldest ones
+RING_SLOTS = 64
+# chunks a new client starts behind the live position, fills the receiver's buffer quickly
+BURST_SLOTS = 8
+# seconds the upstream connection is kept without clients, e.g. while zapping
+IDLE_TIMEOUT = 10
+TIMEOUT = (3, 10)
+
+# stream url -> Relay
+relays = {}
+relays_lock = threading.Lock()
+
+
+class Relay:
+    """
+    One upstream connection fanned out to any number of clients. The received chunks are kept in a ring buffer
+    and handed to every client as the same bytes objects, upstream is never slowed down by a slow client.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.slots = [None] * RING_SLOTS
+        self.head = 0
+        self.condition = threading.Condition()
+        self.closed = False
+        self.connected = threading.Event()
+        self.content_type = 'audio/mpeg'
+        self.clients = 0
+        self.idle_since = time.time()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.bytes_dropped = 0
+
+    def start(self):
+        threading.Thread(target=self.run, name='relay', daemon=True).start()
+
+    def run(self):
+        import requests
+        headers = {'User-Agent': generic.USER_AGENT + '/' + __version__}
+        # requests sessions are not thread-safe, every relay thread has its own
+        session = requests.Session()
+        try:
+            with session.get(self.url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+                if response.status_code != 200:
+                    logging.error("Could not relay stream '%s' (HTML status %s)", self.url, response.status_code)
+                    return
+                self.content_type = response.headers.get('Content-Type', self.content_type)
+                self.connected.set()
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    self.write(chunk)
+                    if self.is_idle():
+                        logging.debug("Closing idle relay of '%s'", self.url)
+                        break
+        except requests.exceptions.RequestException as err:
+            logging.error("Relayed stream '%s' failed (%s)", self.url, err)
+        finally:
+            session.close()
+            self.close()
+
+    def write(self, chunk):
+        with self.condition:
+            self.slots[self.head % RING_SLOTS] = chunk
+            self.head += 1
+            self.bytes_in += len(chunk)
+            self.condition.notify_all()
+
+    def close(self):
+        with relays_lock:
+            if relays.get(self.url) is self:
+                del relays[self.url]
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.connected.set()
+
+    def is_idle(self):
+        with self.condition:
+            return self.clients == 0 and time.time() - self.idle_since > IDLE_TIMEOUT
+
+    def iter_chunks(self):
+        with self.condition:
+            self.clients += 1
+            position = max(0, self.head - BURST_SLOTS)
+        try:
+            while True:
+                with self.condition:
+                    while position >= self.head and not self.closed:
+                        self.condition.wait()
+                    if position >= self.head:
+                        return
+                    if position < self.head - RING_SLOTS:
+                        # backpressure: the client could not keep up, skip to the oldest chunk still kept
+                        for skipped in range(position, self.head - RING_SLOTS):
+                            self.bytes_dropped += len(self.slots[skipped % RING_SLOTS] or b'')
+                        position = self.head - RING_SLOTS
+                    chunk = self.slots[position % RING_SLOTS]
+                    position += 1
+                    self.bytes_out += len(chunk)
+                yield chunk
+        finally:
+            with self.condition:
+                self.clients -= 1
+                if self.clients == 0:
+                    self.idle_since = time.time()
+
+
+def needs_bridge(url, resolve=True):
+    """
+    HTTPS streams are played through the relay if their plain HTTP variant was found not to work, including
+    redirects back to HTTPS. Until the HTTP variant is checked (in the background), it is tried.
+    With resolve=False (station lists) only a known result is used and no check is started.
+    """
+    if not url.startswith('https://'):
+        return False
+    http_url = vtuner.strip_https(url)
+    resolution = stream_resolver.resolutions.get(http_url)
+    if resolve and (resolution is None or not resolution.is_fresh()):
+        stream_resolver.resolve_later(http_url)
+    if resolution is None:
+        return False
+    return not resolution.healthy or resolution.stream_url.startswith('https://')
+
+
+def get_relay(url):
+    """Running relay of the stream, started on first use. Returns None if the stream can not be opened."""
+    with relays_lock:
+        relay = relays.get(url)
+        if relay is None:
+            relay = Relay(url)
+            relays[url] = relay
+            relay.start()
+    relay.connected.wait(sum(TIMEOUT))
+    if relay.closed and relay.head == 0:
+        return None
+    return relay
+
+
+def get_byte_counters():
+    with relays_lock:
+        active = list(relays.values())
+    counters = {}
+    for relay in active:
+        counters[(relay.url, 'in')] = relay.bytes_in
+        counters[(relay.url, 'out')] = relay.bytes_out
+        counters[(relay.url, 'dropped')] = relay.bytes_dropped
+    return counters
+
+
+relay_bytes = metrics.CallbackMetric('ycast_relay_bytes',
+                                     'Bytes received, sent and dropped (slow clients) by the active relays.',
+                                     ('stream', 'direction'), get_byte_counters)
@@ -0,0 +1,176 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ycast import __version__, generic, metrics, tracing
+from ycast.my_filter import get_limit
+
+PLAYLIST_EXTENSIONS = ('.pls', '.m3u')
+PLAYLIST_CONTENT_TYPES = ('audio/x-scpls', 'audio/scpls', 'audio/x-mpegurl', 'audio/mpegurl')
+MAX_PLAYLIST_SIZE = 64 * 1024
+# playlists pointing to playlists
+MAX_DEPTH = 3
+TIMEOUT = (3, 5)
+# broken streams are checked again after this many seconds
+FAILURE_TTL = 300
+RESOLVE_WORKERS = 4
+CACHE_SIZE = 5000
+CODECS = {'audio/mpeg': 'MP3', 'audio/mp3': 'MP3', 'audio/aac': 'AAC', 'audio/aacp': 'AAC+', 'audio/x-aac': 'AAC',
+          'application/ogg': 'OGG', 'audio/ogg': 'OGG', 'audio/flac': 'FLAC', 'audio/x-flac': 'FLAC'}
+
+# station url -> Resolution
+resolutions = {}
+pending = set()
+pending_lock = threading.Lock()
+executor = None
+resolve_flight = metrics.register_single_flight(generic.SingleFlight('Stream resolver'))
+
+
+class Resolution:
+    __slots__ = ('url', 'stream_url', 'healthy', 'content_type', 'codec', 'bitrate', 'timestamp')
+
+    def __init__(self, url, stream_url, healthy, content_type=None, bitrate=None):
+        self.url = url
+        self.stream_url = stream_url
+        self.healthy = healthy
+        self.content_type = content_type
+        self.codec = CODECS.get(content_type)
+        self.bitrate = bitrate
+        self.timestamp = time.time()
+
+    def is_fresh(self):
+        ttl = get_limit('CACHE_TTL') if self.healthy else FAILURE_TTL
+        return time.time() - self.timestamp < ttl
+
+
+def is_playlist_url(url):
+    return url.split('?', 1)[0].lower().endswith(PLAYLIST_EXTENSIONS)
+
+
+def get_resolution(url):
+    resolution = resolutions.get(url)
+    if resolution and resolution.is_fresh():
+        return resolution
+    return None
+
+
+def get_stream_url(url):
+    """
+    Direct stream URL for a station URL. Playlists are expanded before returning, other URLs are checked in the
+    background and the station URL is returned until then.
+    """
+    resolution = get_resolution(url)
+    if resolution is None:
+        if not is_playlist_url(url):
+            resolve_later(url)
+            return url
+        resolution = resolve(url)
+    return resolution.stream_url if resolution.healthy else url
+
+
+def get_cached_stream_url(url):
+    """Like get_stream_url(), but never waits: playlists not resolved yet are resolved in the background."""
+    resolution = get_resolution(url)
+    if resolution is None:
+        if is_playlist_url(url):
+            resolve_later(url)
+        return url
+    return resolution.stream_url if resolution.healthy else url
+
+
+def resolve(url):
+    with tracing.span('stream_resolver.resolve'):
+        resolution = resolve_flight.do(url, fetch_resolution, url)
+    if len(resolutions) >= CACHE_SIZE:
+        resolutions.clear()
+    resolutions[url] = resolution
+    return resolution
+
+
+def resolve_later(url):
+    global executor
+    with pending_lock:
+        if url in pending:
+            return
+        pending.add(url)
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=RESOLVE_WORKERS, thread_name_prefix='stream-resolver')
+    executor.submit(resolve_pending, url)
+
+
+def resolve_pending(url):
+    try:
+        resolve(url)
+    except Exception as ex:
+        logging.error("Could not resolve stream URL '%s': %s", url, ex)
+    finally:
+        with pending_lock:
+            pending.discard(url)
+
+
+def fetch_resolution(url, depth=0, station_url=None):
+    import requests
+    station_url = station_url or url
+    headers = {'User-Agent': generic.USER_AGENT + '/' + __version__}
+    try:
+        response = requests.get(url, headers=headers, stream=True, timeout=TIMEOUT)
+    except requests.exceptions.RequestException as err:
+        logging.info("Stream '%s' not reachable (%s)", url, err)
+        return Resolution(station_url, url, False)
+    try:
+        if response.status_code != 200:
+            logging.info("Stream '%s' not available (HTML status %s)", url, response.status_code)
+            return Resolution(station_url, response.url, False)
+        content_type = response.headers.get('Content-Type', '').split(';', 1)[0].strip().lower()
+        if content_type in PLAYLIST_CONTENT_TYPES or \
+                (is_playlist_url(response.url) and not content_type.startswith(('audio/', 'application/ogg'))):
+            if depth >= MAX_DEPTH:
+                return Resolution(station_url, response.url, False, content_type)
+            entries = parse_playlist(read_playlist(response))
+            if not entries:
+                logging.info("Playlist '%s' without stream URLs", url)
+                return Resolution(station_url, response.url, False, content_type)
+            return fetch_resolution(entries[0], depth + 1, station_url)
+        return Resolution(station_url, response.url, True, content_type, get_bitrate(response.headers))
+    except requests.exceptions.RequestException as err:
+        logging.info("Stream '%s' interrupted (%s)", url, err)
+        return Resolution(station_url, url, False)
+    finally:
+        response.close()
+
+
+def get_bitrate(headers):
+    # announced by Icecast/Shoutcast servers in kbit/s, e.g. 'icy-br: 128' or 'ice-audio-info: bitrate=128;...'
+    bitrate = headers.get('icy-br', '').split(',', 1)[0]
+    if not bitrate:
+        for info in headers.get('ice-audio-info', '').split(';'):
+            if info.startswith(('bitrate=', 'ice-bitrate=')):
+                bitrate = info.split('=', 1)[1]
+    try:
+        return int(bitrate)
+    except ValueError:
+        return None
+
+
+def read_playlist(response):
+    content = b''
+    for chunk in response.iter_content(chunk_size=4096):
+        content += chunk
+        if len(content) >= MAX_PLAYLIST_SIZE:
+            break
+    return content.decode('utf-8', 'replace')
+
+
+def parse_playlist(text):
+    """Stream URLs of a PLS or M3U playlist, in order."""
+    entries = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line.lower().startswith('file') and '=' in line:
+            line = line.split('=', 1)[1].strip()
+        elif line.startswith('#'):
+            continue
+        if line.startswith(('http://', 'https://')):
+            entries.append(line)
+    return entries
@@ -0,0 +1,78 @@
+import json
+import logging
+import threading
+import time
+
+_local = threading.local()
+
+
+class Trace:
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        # span name -> [count, total seconds, seconds spent in nested spans]
+        self.spans = {}
+        self.stack = []
+
+    def get_stats(self, name):
+        stats = self.spans.get(name)
+        if stats is None:
+            stats = self.spans[name] = [0, 0.0, 0.0]
+        return stats
+
+    def to_dict(self, duration):
+        spans = {}
+        accounted = 0.0
+        for name, (count, total, nested) in self.spans.items():
+            spans[name] = {'count': count, 'total_ms': round(total * 1000, 1),
+                           'self_ms': round((total - nested) * 1000, 1)}
+            accounted += total - nested
+        return {'request': self.name, 'duration_ms': round(duration * 1000, 1), 'spans': spans,
+                'unaccounted_ms': round((duration - accounted) * 1000, 1)}
+
+
+class Span:
+    __slots__ = ('name', 'trace', 'start')
+
+    def __init__(self, name):
+        self.name = name
+        self.trace = None
+
+    def __enter__(self):
+        self.trace = getattr(_local, 'trace', None)
+        if self.trace is not None:
+            self.trace.stack.append(self)
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        trace = self.trace
+        if trace is None:
+            return False
+        duration = time.perf_counter() - self.start
+        trace.stack.pop()
+        stats = trace.get_stats(self.name)
+        stats[0] += 1
+        stats[1] += duration
+        if trace.stack:
+            trace.get_stats(trace.stack[-1].name)[2] += duration
+        return False
+
+
+def span(name):
+    return Span(name)
+
+
+def start_trace(name):
+    _local.trace = Trace(name)
+
+
+def finish_trace(threshold_ms):
+    trace = getattr(_local, 'trace', None)
+    _local.trace = None
+    if trace is None:
+        return None
+    duration = time.perf_counter() - trace.start
+    if duration * 1000 > threshold_ms:
+        logging.warning("Slow request: %s", json.dumps(trace.to_dict(duration)))
+    return duration
@@ -1,5 +1,7 @@
 import xml.etree.ElementTree as ET
 
+from ycast import tracing
+
 XML_HEADER = '<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>'
 
 
@@ -20,6 +22,8 @@ def add_bogus_parameter(url):
     The original vTuner API hacks around that by adding a specific parameter or a bogus parameter like '?empty=' to
     the target URL.
     """
+    if '?' in url:
+        return url + '&vtuner=true'
     return url + '?vtuner=true'
 
 
@@ -28,6 +32,8 @@ class Page:
         self.items = []
         self.count = -1
         self.dontcache = False
+        # Display shown above the (paged) items, counted with them
+        self.notice = None
 
     def add_item(self, item):
         self.items.append(item)
@@ -35,17 +41,28 @@ class Page:
     def set_count(self, count):
         self.count = count
 
+    def set_notice(self, text):
+        self.notice = Display(text)
+
     def to_xml(self):
         xml = ET.Element('ListOfItems')
-        ET.SubElement(xml, 'ItemCount').text = str(self.count)
+        count = self.count
+        items = self.items
+        if self.notice:
+            if count >= 0:
+                count += 1
+            position = 1 if items and isinstance(items[0], Previous) else 0
+            items = items[:position] + [self.notice] + items[position:]
+        ET.SubElement(xml, 'ItemCount').text = str(count)
         if self.dontcache:
             ET.SubElement(xml, 'NoDataCache').text = 'Yes'
-        for item in self.items:
+        for item in items:
             xml.append(item.to_xml())
         return xml
 
     def to_string(self):
-        return XML_HEADER + ET.tostring(self.to_xml()).decode('utf-8')
+        with tracing.span('vtuner.to_string'):
+            return XML_HEADER + ET.tostring(self.to_xml()).decode('utf-8')
 
 
 class Previous:
@@ -116,37 +133,36 @@ class Directory:
 
 
 class Station:
-    def __init__(self, uid, name, description, url, icon, genre, location, mime, bitrate, bookmark):
-        self.uid = uid
-        self.name = name
-        self.description = description
-        self.url = strip_https(url)
+    def __init__(self, station, bookmark=None):
+        self.station = station
+        self.url = strip_https(station.url)
         self.trackurl = None
-        self.icon = icon
-        self.genre = genre
-        self.location = location
-        self.mime = mime
-        self.bitrate = bitrate
+        self.icon = station.icon
         self.bookmark = bookmark
 
+    @property
+    def uid(self):
+        return self.station.id
+
     def set_trackurl(self, url):
         self.trackurl = url
 
     def to_xml(self):
+        station = self.station
         item = ET.Element('Item')
         ET.SubElement(item, 'ItemType').text = 'Station'
-        ET.SubElement(item, 'StationId').text = self.uid
-        ET.SubElement(item, 'StationName').text = self.name
+        ET.SubElement(item, 'StationId').text = station.id
+        ET.SubElement(item, 'StationName').text = station.name
         if self.trackurl:
             ET.SubElement(item, 'StationUrl').text = self.trackurl
         else:
             ET.SubElement(item, 'StationUrl').text = self.url
-        ET.SubElement(item, 'StationDesc').text = self.description
+        ET.SubElement(item, 'StationDesc').text = station.description
         ET.SubElement(item, 'Logo').text = self.icon
-        ET.SubElement(item, 'StationFormat').text = self.genre
-        ET.SubElement(item, 'StationLocation').text = self.location
-        ET.SubElement(item, 'StationBandWidth').text = str(self.bitrate)
-        ET.SubElement(item, 'StationMime').text = self.mime
+        ET.SubElement(item, 'StationFormat').text = station.genre
+        ET.SubElement(item, 'StationLocation').text = station.countrycode
+        ET.SubElement(item, 'StationBandWidth').text = str(station.bitrate)
+        ET.SubElement(item, 'StationMime').text = station.codec
         ET.SubElement(item, 'Relia').text = '3'
         ET.SubElement(item, 'Bookmark').text = self.bookmark
         return item